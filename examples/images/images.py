@@ -1,10 +1,10 @@
 # -*- encoding: utf-8
 
-import json
 import os
 
 import maya
 
+from taggle import serializer
 from taggle.elastic import DATE_FORMAT
 from taggle.models import TaggedDocument
 
@@ -24,7 +24,7 @@ class ImageManager:
         return os.path.join(self.cache_dir, path)
 
     def get_image_metadata(self):
-        return json.load(open(self.cache_path('metadata.json')))
+        return serializer.load(self.cache_path('metadata.json'))
 
     def download_assets(self):
         print('Calling download_assets...')
@@ -32,8 +32,6 @@ class ImageManager:
 
     def get_data_for_indexing(self):
         for doc in self.get_image_metadata():
-            print(maya.parse(
-                doc['date_added']).datetime().strftime(DATE_FORMAT))
             doc['date_added'] = maya.parse(
                 doc['date_added']).datetime().strftime(DATE_FORMAT)
             yield TaggedDocument(**doc)
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8
 """
-Usage: viewer.py --app_password=<APPPASSWORD> --es_host=<HOST> --loris_host=<LORIS_HOST> [--debug]
+Usage: viewer.py --app_password=<APPPASSWORD> --es_host=<HOST> --loris_host=<LORIS_HOST> [--debug] [--reindex]
 """
 
 import datetime as dt
@@ -12,7 +12,6 @@ import time
 from urllib.parse import quote_plus as urlencode
 
 import docopt
-from elasticsearch import Elasticsearch
 from flask import render_template, request, url_for, Flask
 from flask_apscheduler import APScheduler
 from flask_login import login_required
@@ -23,10 +22,11 @@ ROOT = subprocess.check_output(
     ['git', 'rev-parse', '--show-toplevel']).strip().decode('utf8')
 sys.path.append(ROOT)
 
-from taggle.elastic import index_documents, search_documents
-from taggle.flask_utils import TaggleApp
+from taggle.client import get_client
+from taggle.elastic import index_documents, reindex, search_documents
+from taggle.flask_utils import tag_cloud_filter, TaggleApp
 from taggle.login import configure_login
-from taggle.tagcloud import build_tag_cloud, TagcloudOptions
+from taggle.tagcloud import TagcloudOptions
 
 from filters import title_markdown
 from images import ImageManager
@@ -42,9 +42,7 @@ options = TagcloudOptions(
     size_start=9, size_end=24, colr_start='#999999', colr_end='#3b0caa'
 )
 
-app.jinja_env.filters['build_tag_cloud'] = lambda t: build_tag_cloud(
-    t, options
-)
+app.jinja_env.filters['tag_cloud'] = tag_cloud_filter(options)
 
 app.jinja_env.filters['extension'] = lambda t: t.split('.')[-1].lower().replace('jpeg', 'jpg')
 
@@ -65,13 +63,17 @@ def update_index():
             print(f'Index already up-to-date at {time.time()}...')
             return
     except FileNotFoundError:
-        pass
+        mtime = time.time()
 
-    print(list(manager.get_data_for_indexing()))
     index_documents(
         client=client,
         index_name='images',
-        documents=list(manager.get_data_for_indexing())
+        documents=manager.get_data_for_indexing(),
+        incremental=True,
+
+        # If a slow run overlaps with a newer one (e.g. in another
+        # process), the newer data wins.
+        version=int(mtime * 1000)
     )
 
 
@@ -85,7 +87,8 @@ def index():
         client=client,
         index_name='images',
         query_string=query_string,
-        page=int(request.args.get('page', '1'))
+        page=int(request.args.get('page', '1')),
+        cursor=request.args.get('cursor')
     )
 
     return render_template(
@@ -127,10 +130,18 @@ class Config(object):
 if __name__ == '__main__':
     args = docopt.docopt(__doc__)
 
-    client = Elasticsearch(hosts=[f'http://{args["--es_host"]}'])
+    client = get_client(f'http://{args["--es_host"]}')
 
     manager = ImageManager()
 
+    if args['--reindex']:
+        reindex(
+            client=client,
+            alias='images',
+            documents=manager.get_data_for_indexing(),
+            workers=4
+        )
+
     app.config.from_object(Config(manager))
     app.config['LORIS_HOST'] = args['--loris_host']
 
@@ -12,6 +12,7 @@ import readability
 import requests
 from requests.exceptions import RequestException
 
+from taggle import serializer
 from taggle.elastic import DATE_FORMAT
 from taggle.models import TaggedDocument
 
@@ -68,7 +69,7 @@ class PinboardManager:
             return self._get_enriched_data()
         else:
             print("We're already up-to-date!")
-            return json.load(open(self.cache_path('enriched_metadata.json')))
+            return serializer.load(self.cache_path('enriched_metadata.json'))
 
     def _login_pinboard_sess(self):
         sess = requests.Session()
@@ -154,9 +155,9 @@ class PinboardManager:
             'metadata': pinboard_metadata,
         }
 
-        json_str = json.dumps(enriched_metadata)
-        with open(self.cache_path('enriched_metadata.json'), 'w') as f:
-            f.write(json_str)
+        serializer.dump(
+            enriched_metadata, self.cache_path('enriched_metadata.json')
+        )
 
         return enriched_metadata
 
@@ -165,7 +166,7 @@ class PinboardManager:
         txt_dir = os.path.join(self.cache_dir, 'txt')
         os.makedirs(txt_dir, exist_ok=True)
         try:
-            data = json.load(open(self.cache_path('enriched_metadata.json')))
+            data = serializer.load(self.cache_path('enriched_metadata.json'))
         except FileNotFoundError:
             return
 
@@ -208,13 +209,15 @@ class PinboardManager:
 
     def get_data_for_indexing(self):
         try:
-            data = json.load(open(self.cache_path('enriched_metadata.json')))
+            data = serializer.load(self.cache_path('enriched_metadata.json'))
         except FileNotFoundError:
             return
 
+        starred = set(data['starred'])
+
         for bookmark in data['metadata']:
             id = bookmark['id']
-            is_starred = id in data['starred']
+            is_starred = id in starred
             archive_id = data['archive_links'].get(id)
             if archive_id is not None:
                 archive_id = archive_id.replace('/cached', '').replace('/', '')
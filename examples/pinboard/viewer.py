@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8
 """
-Usage: viewer.py --pin_username=<PIN_USERNAME> --pin_password=<PIN_PASSWORD> --app_password=<APPPASSWORD> --es_host=<HOST> [--debug]
+Usage: viewer.py --pin_username=<PIN_USERNAME> --pin_password=<PIN_PASSWORD> --app_password=<APPPASSWORD> --es_host=<HOST> [--debug] [--reindex]
 """
 
 import datetime as dt
@@ -11,7 +11,6 @@ import sys
 import time
 
 import docopt
-from elasticsearch import Elasticsearch
 from flask import render_template, request, url_for, Flask
 from flask_apscheduler import APScheduler
 from flask_login import login_required
@@ -22,9 +21,13 @@ import maya
 sys.path.append(subprocess.check_output(
     ['git', 'rev-parse', '--show-toplevel']).strip().decode('utf8'))
 
-from taggle.elastic import add_tag_to_query, index_documents, search_documents
+from taggle.client import get_client
+from taggle.elastic import (
+    add_tag_to_query, index_documents, IndexProfile, reindex, search_documents
+)
+from taggle.flask_utils import tag_cloud_filter
 from taggle.login import configure_login
-from taggle.tagcloud import build_tag_cloud, TagcloudOptions
+from taggle.tagcloud import TagcloudOptions
 
 from filters import description_markdown, title_markdown
 from pinboard import PinboardManager
@@ -34,22 +37,26 @@ from tagsort import custom_tag_sort
 app = Flask(__name__)
 
 
-def _build_pagination_url(desired_page):
+def _build_pagination_url(desired_page, cursor):
     if desired_page < 1:
         return None
     args = request.args.copy()
     args['page'] = desired_page
+    if cursor is None or desired_page == 1:
+        args.pop('cursor', None)
+    else:
+        args['cursor'] = cursor
     return url_for(request.endpoint, **args)
 
 
-def next_page_url(request):
+def next_page_url(request, results):
     page = int(request.args.get('page', '1'))
-    return _build_pagination_url(page + 1)
+    return _build_pagination_url(page + 1, cursor=results.next_cursor)
 
 
-def prev_page_url(request):
+def prev_page_url(request, results):
     page = int(request.args.get('page', '1'))
-    return _build_pagination_url(page - 1)
+    return _build_pagination_url(page - 1, cursor=results.prev_cursor)
 
 
 def generation_time(start_time):
@@ -67,13 +74,39 @@ app.jinja_env.filters['prev_page_url'] = prev_page_url
 app.jinja_env.filters['slang_time'] = lambda d: maya.parse(d).slang_time()
 app.jinja_env.filters['title_markdown'] = title_markdown
 
+profile = IndexProfile(
+    fields={
+        # Archived pages are by far the biggest thing in the index.  We keep
+        # positions so phrase searches still work, but length norms aren't
+        # much use for scoring whole web pages.
+        'full_text': {'type': 'text', 'norms': False},
+
+        # These are only used to build links, never searched.
+        'archive_id': {'type': 'keyword', 'index': False},
+        'slug': {'type': 'keyword', 'index': False},
+
+        'starred': {'type': 'boolean'},
+        'toread': {'type': 'boolean'},
+    },
+
+    # Everything the bookmark template uses -- which means we never fetch
+    # the archived text just to render a page of results.
+    listing_fields=[
+        'archive_id',
+        'description',
+        'slug',
+        'starred',
+        'title',
+        'toread',
+        'url',
+    ]
+)
+
 options = TagcloudOptions(
     size_start=9, size_end=24, colr_start='#999999', colr_end='#ca3b0c'
 )
 
-app.jinja_env.filters['build_tag_cloud'] = lambda t: build_tag_cloud(
-    t, options
-)
+app.jinja_env.filters['tag_cloud'] = tag_cloud_filter(options)
 
 # The query is exposed in the <input> search box with the ``safe`` filter,
 # so HTML entities aren't escaped --- but we need to avoid closing the
@@ -90,12 +123,18 @@ def update_index():
             print('Index already up-to-date...')
             return
     except FileNotFoundError:
-        pass
+        mtime = time.time()
 
     index_documents(
         client=client,
         index_name='pinboard',
-        documents=list(manager.get_data_for_indexing())
+        documents=manager.get_data_for_indexing(),
+        incremental=True,
+        profile=profile,
+
+        # If a slow run overlaps with a newer one (e.g. in another
+        # process), the newer data wins.
+        version=int(mtime * 1000)
     )
 
 
@@ -110,11 +149,8 @@ def index():
         index_name='pinboard',
         query_string=query_string,
         page=int(request.args.get('page', '1')),
-        query_params={
-            '_source': {
-                'excludes': ['full_text']
-            }
-        }
+        cursor=request.args.get('cursor'),
+        profile=profile
     )
 
     return render_template(
@@ -162,13 +198,22 @@ class Config(object):
 if __name__ == '__main__':
     args = docopt.docopt(__doc__)
 
-    client = Elasticsearch(hosts=[f'http://{args["--es_host"]}'])
+    client = get_client(f'http://{args["--es_host"]}')
 
     manager = PinboardManager(
         username=args['--pin_username'],
         password=args['--pin_password']
     )
 
+    if args['--reindex']:
+        reindex(
+            client=client,
+            alias='pinboard',
+            documents=manager.get_data_for_indexing(),
+            workers=4,
+            profile=profile
+        )
+
     app.config.from_object(Config(manager))
     app.jinja_env.undefined = StrictUndefined
 
@@ -0,0 +1,81 @@
+# -*- encoding: utf-8
+"""A small in-process LRU cache, for things that are expensive to fetch
+but cheap to keep around for a while.
+"""
+
+import collections
+import threading
+import time
+
+
+class LRUCache:
+    """A thread-safe LRU cache with optional expiry and a memory limit.
+
+    :param max_entries: The most entries to hold at once.
+    :param max_bytes: If set, evict entries once the total size of the
+        cached values goes above this.  The size of each value is passed
+        to ``set``, because only the caller knows how to measure it.
+    :param ttl: If set, entries expire this many seconds after being set.
+
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=None, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._entries = collections.OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<%s entries=%d bytes=%d>' % (
+            type(self).__name__, len(self._entries), self._total_bytes)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size, expires = self._entries[key]
+            except KeyError:
+                return default
+
+            if expires is not None and expires < time.monotonic():
+                self._remove(key)
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, size=0):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            if self.ttl is None:
+                expires = None
+            else:
+                expires = time.monotonic() + self.ttl
+
+            self._entries[key] = (value, size, expires)
+            self._total_bytes += size
+
+            while self._entries and (
+                len(self._entries) > self.max_entries or
+                (
+                    self.max_bytes is not None and
+                    self._total_bytes > self.max_bytes
+                )
+            ):
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._total_bytes -= size
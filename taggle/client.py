@@ -0,0 +1,99 @@
+# -*- encoding: utf-8
+"""Create and share Elasticsearch clients.
+
+A client is safe to share between threads -- each node gets a pool of
+keep-alive connections, and a request takes a connection from the pool
+for as long as it runs.  So each process needs one client per cluster,
+with a pool big enough for the request threads, the scheduler's indexing
+job and its bulk workers to run at once.  If the pool is too small,
+urllib3 opens a fresh connection for each request that doesn't fit, and
+throws it away afterwards.
+
+Connections can't be shared across a fork, so clients are cached per
+process: a worker forked from a process that already had a client gets
+a new one the first time it asks.
+
+"""
+
+import os
+import threading
+
+from elasticsearch import Elasticsearch
+
+from taggle.elastic import FastJSONSerializer
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(hosts,
+               maxsize=25,
+               timeout=10,
+               max_retries=3,
+               retry_on_timeout=True,
+               sniff=False,
+               sniffer_timeout=60,
+               **kwargs):
+    """Returns an Elasticsearch client for ``hosts``, creating it if this
+    process doesn't already have one.
+
+    :param maxsize: How many connections to keep open to each node.
+    :param timeout: How long to wait for a response, in seconds.  Pass
+        ``request_timeout`` to an API call to override this, e.g. for a
+        large bulk request.
+    :param max_retries: How many times to retry a request that fails with
+        a connection error (or a timeout, if ``retry_on_timeout`` is set),
+        on another node if there is one.
+    :param sniff: Whether to discover the other nodes in the cluster, when
+        the client starts, after a connection fails, and then every
+        ``sniffer_timeout`` seconds.  Leave this off if the cluster is
+        behind a proxy or load balancer, or the nodes publish addresses
+        we can't reach (e.g. inside Docker).
+
+    Any other keyword arguments are passed to ``Elasticsearch``.  Calls with
+    the same arguments share a client.
+
+    """
+    if isinstance(hosts, str):
+        hosts = [hosts]
+
+    options = dict(
+        maxsize=maxsize,
+        timeout=timeout,
+        max_retries=max_retries,
+        retry_on_timeout=retry_on_timeout,
+        **kwargs
+    )
+    if sniff:
+        options.update(
+            sniff_on_start=True,
+            sniff_on_connection_fail=True,
+            sniffer_timeout=sniffer_timeout
+        )
+
+    key = (os.getpid(), repr(hosts), repr(sorted(options.items())))
+
+    with _clients_lock:
+        try:
+            return _clients[key]
+        except KeyError:
+            options.setdefault('serializer', FastJSONSerializer())
+            client = Elasticsearch(hosts=hosts, **options)
+            _clients[key] = client
+            return client
+
+
+def close_clients():
+    """Close every client created by this process, e.g. when it shuts down.
+
+    Clients inherited from a parent process are dropped without closing
+    their connections, which belong to the parent.
+
+    """
+    pid = os.getpid()
+    with _clients_lock:
+        for key, client in list(_clients.items()):
+            if key[0] == pid:
+                client.transport.close()
+            del _clients[key]
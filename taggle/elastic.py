@@ -1,123 +1,1138 @@
 # -*- encoding: utf-8
 
-import math
-import shlex
+import asyncio
+import base64
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+import inspect
+import itertools
+import json
+import threading
 import time
 
 import attr
-from elasticsearch.exceptions import RequestError as ElasticsearchRequestError
-from elasticsearch.helpers import bulk as bulk_helper
+from elasticsearch.exceptions import (
+    RequestError as ElasticsearchRequestError,
+    SerializationError,
+    TransportError
+)
+from elasticsearch.helpers import (
+    _chunk_actions, expand_action, scan, streaming_bulk
+)
+from elasticsearch.serializer import JSONSerializer
 
-from taggle.models import TaggedDocument
+from taggle import serializer
+from taggle.cache import LRUCache
+from taggle.models import LazyDocuments, ResultList
+from taggle.query import compile_query
 
 
 DATE_FORMAT = '%Y%m%dT%H%M%SZ'
 
 
-@attr.s
-class ResultList:
-    """Represents a set of results from Elasticsearch.
+class FastJSONSerializer(JSONSerializer):
+    """A drop-in for the client's serializer that uses ``taggle.serializer``,
+    so requests and responses go through orjson if it's installed::
 
-    This stores some information about the results from the query, and
-    some convenience methods about records on the query.
+        Elasticsearch(hosts=[...], serializer=FastJSONSerializer())
 
     """
-    total_size = attr.ib()
-    page = attr.ib()
-    page_size = attr.ib()
-    documents = attr.ib()
-    tags = attr.ib()
 
-    @property
-    def start_idx(self):
-        return 1 + self.page_size * (self.page - 1)
+    def loads(self, s):
+        try:
+            return serializer.loads(s)
+        except (ValueError, TypeError) as err:
+            raise SerializationError(s, err)
 
-    @property
-    def end_idx(self):
-        return min(self.total_size, self.page_size * self.page)
+    def dumps(self, data):
+        # Strings are already serialised, e.g. the body of a bulk request.
+        if isinstance(data, str):
+            return data
 
-    @property
-    def total_pages(self):
-        return math.ceil(self.total_size / self.page_size)
+        try:
+            return serializer.dumps(data, default=self.default)
+        except (ValueError, TypeError) as err:
+            raise SerializationError(data, err)
 
 
-def create_index(client, name):
-    """Creates an index with the appropriate mapping for the tags field."""
-    try:
-        client.indices.create(
-            index=name,
-            body={
-                'mappings': {
-                    name: {
-                        'properties': {
-                            'date_added': {
-                                'type': 'date',
-                                'format': 'basic_date_time_no_millis',
-                            },
-                            'tags': {
-                                'type': 'text',
-                                'fields': {
-                                    'raw': {'type': 'keyword'}
-                                }
-                            }
-                        }
+# A copy of the document ID, for sorting.  Sorting on ``_id`` itself loads
+# it into fielddata on the heap; this field has doc values on disk instead.
+_ID_FIELD = {'type': 'keyword'}
+
+
+@attr.s
+class IndexProfile:
+    """Describes the settings and mapping for an index.
+
+    :param refresh_interval: How often Elasticsearch makes new writes
+        visible to search.  ``index_documents`` refreshes after every run
+        that writes something, so this can be long enough that we don't
+        spend time on refreshes between runs.
+    :param fields: Explicit mappings for fields in the document metadata,
+        e.g. to set ``index_options`` on a large text field.  Anything not
+        listed here is mapped dynamically.
+    :param source_excludes: Fields that are indexed but left out of the
+        stored ``_source``.  This saves disk and network, but the fields
+        can't be returned in search results or recovered by a reindex.
+    :param listing_fields: The metadata fields that a page of search
+        results needs.  If set, ``search_documents`` only fetches these
+        fields (plus the tags and date) from the ``_source``.  If not,
+        it fetches the whole document.
+
+    """
+    refresh_interval = attr.ib(default='30s')
+    fields = attr.ib(default=attr.Factory(dict))
+    source_excludes = attr.ib(default=attr.Factory(list))
+    listing_fields = attr.ib(default=None)
+
+    def source_filter(self):
+        """Returns the ``_source`` filter for a page of search results, or
+        None if we want the whole document.
+        """
+        if self.listing_fields is None:
+            return None
+        fields = {'tags', 'date_added'} | set(self.listing_fields)
+        return {'includes': sorted(fields)}
+
+    def mapping(self):
+        properties = {
+            'doc_id': _ID_FIELD,
+            'date_added': {
+                'type': 'date',
+                'format': 'basic_date_time_no_millis',
+            },
+            'tags': {
+                'type': 'text',
+                'fields': {
+                    'raw': {
+                        'type': 'keyword',
+
+                        # Every search runs a terms aggregation on this
+                        # field, so build the global ordinals at refresh
+                        # time rather than on the first search after it.
+                        'eager_global_ordinals': True,
                     }
                 }
             }
-        )
-    except ElasticsearchRequestError as err:
-        if err.info['error']['type'] == 'resource_already_exists_exception':
+        }
+        properties.update(self.fields)
+
+        mapping = {'properties': properties}
+        if self.source_excludes:
+            mapping['_source'] = {'excludes': self.source_excludes}
+        return mapping
+
+
+DEFAULT_PROFILE = IndexProfile()
+
+
+def create_index(client,
+                 name,
+                 doc_type=None,
+                 settings=None,
+                 profile=DEFAULT_PROFILE):
+    """Creates an index with the mapping and settings from ``profile``.
+
+    The mapping type defaults to the name of the index.  ``name`` can also
+    be an alias for another index (see ``reindex``).  Any ``settings``
+    override the settings in the profile.
+
+    Note that this doesn't change the profile of an existing index -- use
+    ``reindex`` to rebuild it with the new profile.  We only add the
+    ``doc_id`` field to its mapping, if it isn't already there.
+
+    """
+    if doc_type is None:
+        doc_type = name
+
+    if not client.indices.exists_alias(name=name):
+        try:
+            client.indices.create(
+                index=name,
+                body=_index_body(doc_type, settings=settings, profile=profile)
+            )
+            return
+        except ElasticsearchRequestError as err:
+            if not _is_already_exists(err):
+                raise
+
+    client.indices.put_mapping(
+        index=name, doc_type=doc_type, body=_id_field_mapping()
+    )
+
+
+async def _async_create_index(client, name, doc_type, profile):
+    """The asyncio version of ``create_index``."""
+    if not await client.indices.exists_alias(name=name):
+        try:
+            await client.indices.create(
+                index=name,
+                body=_index_body(doc_type, settings=None, profile=profile)
+            )
+            return
+        except ElasticsearchRequestError as err:
+            if not _is_already_exists(err):
+                raise
+
+    await client.indices.put_mapping(
+        index=name, doc_type=doc_type, body=_id_field_mapping()
+    )
+
+
+def _id_field_mapping():
+    # Indexes created before we sorted on ``doc_id`` don't have it in their
+    # mapping.  We add it before we write any documents, because a dynamic
+    # mapping would make it a text field, which can't be sorted on.
+    return {'properties': {'doc_id': _ID_FIELD}}
+
+
+def _is_already_exists(err):
+    # Another process may have created the index since we checked.
+    return err.info['error']['type'] == 'resource_already_exists_exception'
+
+
+def _index_body(doc_type, settings, profile):
+    index_settings = {'refresh_interval': profile.refresh_interval}
+    if settings is not None:
+        index_settings.update(settings)
+
+    return {
+        'settings': {'index': index_settings},
+        'mappings': {doc_type: profile.mapping()},
+    }
+
+
+# Fingerprints of every document sent to Elasticsearch in the last
+# successful call to ``index_documents``, keyed by index name and then by
+# document ID.  This lets us skip documents that haven't changed, and only
+# send the fields that have.
+_last_indexed = {}
+
+
+def _document_fields(doc):
+    """Returns the fields we send to Elasticsearch for a document."""
+    fields = {'doc_id': doc.id, 'tags': doc.tags, 'date_added': doc.date_added}
+    fields.update(doc.metadata)
+    return fields
+
+
+def _fingerprint(fields):
+    """Returns a hash of each of the fields of a document, so we can tell
+    which of them have changed since it was last indexed.
+    """
+    fingerprint = {}
+    for name, value in fields.items():
+        content = json.dumps(value, sort_keys=True, default=str)
+        fingerprint[name] = hashlib.blake2b(
+            content.encode('utf8'), digest_size=8
+        ).digest()
+    return fingerprint
+
+
+def _changed_fields(previous, fingerprint):
+    """Returns the names of the fields that differ between two
+    fingerprints, or None if the whole document has to be sent again.
+    """
+    # A partial update can't remove a field, and if we don't know what
+    # was sent last time, we can't tell what's changed.
+    if previous is None or previous.keys() - fingerprint.keys():
+        return None
+
+    return {
+        name
+        for name, value in fingerprint.items()
+        if previous.get(name) != value
+    }
+
+
+def _indexed_ids(client, index_name):
+    """Generates the ID of every document in an index.
+
+    This uses the scroll API, so it isn't capped by ``index.max_result_window``
+    and only holds one page of IDs in memory at a time.
+
+    """
+    hits = scan(
+        client,
+        index=index_name,
+        query={'query': {'match_all': {}}},
+        _source=False
+    )
+    for hit in hits:
+        yield hit['_id']
+
+
+def _batches(iterable, size):
+    """Split an iterable into lists of at most ``size`` items."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _bulk_results(client, actions, workers, queue_size, **kwargs):
+    """Send a series of bulk actions to Elasticsearch, and generate the
+    (ok, item) result for each of them.
+
+    If ``workers`` is more than 1, chunks are sent from a thread pool, with
+    at most ``queue_size`` chunks in flight at once -- so we still consume
+    the actions lazily, rather than reading them all into the queue.
+    Results come back in the same order as the actions.
+
+    """
+    if workers <= 1:
+        yield from streaming_bulk(client, actions, **kwargs)
+        return
+
+    def _send(batch):
+        return list(streaming_bulk(client, batch, **kwargs))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = collections.deque()
+        for batch in _batches(actions, size=kwargs['chunk_size']):
+            in_flight.append(executor.submit(_send, batch))
+            if len(in_flight) >= queue_size:
+                yield from in_flight.popleft().result()
+
+        while in_flight:
+            yield from in_flight.popleft().result()
+
+
+def _bulk(client,
+          actions,
+          chunk_size,
+          max_chunk_bytes,
+          workers=1,
+          queue_size=None,
+          max_retries=3,
+          initial_backoff=2):
+    """Stream a series of bulk actions into Elasticsearch, printing progress
+    after every chunk.
+
+    The actions are consumed lazily, and sent in chunks bounded by both the
+    number of actions and their serialised size.  Chunks rejected with a 429
+    (because the cluster's bulk queue is full) are retried with exponential
+    backoff, starting at ``initial_backoff`` seconds.
+
+    Returns the number of documents written, and the IDs of any documents
+    that couldn't be written.
+
+    """
+    results = _bulk_results(
+        client,
+        actions,
+        workers=workers,
+        queue_size=queue_size or 2 * workers,
+        chunk_size=chunk_size,
+        max_chunk_bytes=max_chunk_bytes,
+        max_retries=max_retries,
+        initial_backoff=initial_backoff,
+        raise_on_error=False
+    )
+
+    progress = _BulkProgress(chunk_size=chunk_size)
+    for ok, item in results:
+        progress.record(ok, item)
+    return progress.finish()
+
+
+class _BulkProgress:
+    """Counts the results of a bulk load, printing progress after every
+    chunk, and remembers the IDs of any documents that failed.
+    """
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.count = 0
+        self.written = 0
+        self.conflicts = 0
+        self.failed = set()
+
+    def record(self, ok, item):
+        self.count += 1
+        op_type, info = item.popitem()
+
+        # Deleting a document that's already gone isn't a failure -- but
+        # it isn't a write either, so it doesn't need a refresh.
+        if op_type == 'delete' and info.get('status') == 404:
             pass
+        elif ok:
+            self.written += 1
         else:
-            raise
-
-
-def index_documents(client, index_name, documents):
-    """Index a series of documents into an Elasticsearch index."""
-    create_index(client=client, name=index_name)
-
-    def _actions():
-        for doc in documents:
-            act = {
-                '_op_type': 'index',
-                '_index': index_name,
-                '_type': index_name,
-                '_id': doc.id,
-                'tags': doc.tags,
-                'date_added': doc.date_added,
-            }
-            act.update(**doc.metadata)
-            yield act
+            # A version conflict means Elasticsearch already has a newer
+            # copy of the document, which is fine -- but we still treat it
+            # as a failure, so our fingerprint doesn't claim otherwise.
+            if info.get('status') == 409:
+                self.conflicts += 1
+            else:
+                print(f'Failed to write {info["_id"]}: {info.get("error")}')
+            self.failed.add(info['_id'])
+
+        if self.count % self.chunk_size == 0:
+            print(f'Processed {self.count} documents...')
+
+    def finish(self):
+        if self.count % self.chunk_size:
+            print(f'Processed {self.count} documents...')
+        if self.conflicts:
+            print(f'Skipped {self.conflicts} documents with newer versions')
+        return self.written, self.failed
 
-    actions = list(_actions())
-    for _ in range(3):
-        _, actions = bulk_helper(client=client, actions=actions)
-        if not actions:
-            break
+
+# One lock per index, so only one call in this process writes to an index at
+# a time.  If a scheduled update is still running when the next one fires,
+# the second one skips its turn, rather than racing the first on the same
+# documents.
+_index_locks = collections.defaultdict(threading.Lock)
+_index_locks_lock = threading.Lock()
+
+
+def _single_flight(name_arg):
+    """Decorates a function that writes to the index named by its argument
+    ``name_arg``, so that if it's called while another call is writing to
+    the same index, it prints a message and returns None.
+    """
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        def _acquire(args, kwargs):
+            name = signature.bind(*args, **kwargs).arguments[name_arg]
+            with _index_locks_lock:
+                lock = _index_locks[name]
+            if lock.acquire(blocking=False):
+                return lock
+            print(f'Already updating {name}, skipping...')
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                lock = _acquire(args, kwargs)
+                if lock is not None:
+                    try:
+                        return await fn(*args, **kwargs)
+                    finally:
+                        lock.release()
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                lock = _acquire(args, kwargs)
+                if lock is not None:
+                    try:
+                        return fn(*args, **kwargs)
+                    finally:
+                        lock.release()
+
+        return wrapper
+
+    return decorator
+
+
+@_single_flight('index_name')
+def index_documents(client,
+                    index_name,
+                    documents,
+                    incremental=False,
+                    chunk_size=500,
+                    max_chunk_bytes=10 * 1024 * 1024,
+                    workers=1,
+                    queue_size=None,
+                    doc_type=None,
+                    profile=DEFAULT_PROFILE,
+                    facets=None,
+                    version=None):
+    """Index a series of documents into an Elasticsearch index.
+
+    The documents can be any iterable (e.g. a generator), and are consumed
+    lazily -- we only hold a few chunks of documents in memory at a time.
+
+    Set ``workers`` to send chunks from that many threads in parallel, with
+    at most ``queue_size`` chunks (default: twice the number of workers)
+    in flight.  This is useful for a full rebuild of a large index.
+
+    If ``incremental`` is True, we only send documents that have changed
+    since the last successful run (in this process), and only delete the
+    documents that have disappeared since then.  The first run always sends
+    everything.
+
+    If only some of the fields of a document have changed -- e.g. its tags,
+    but not its text -- we send an ``update`` with just those fields.  This
+    relies on Elasticsearch having the rest of the document in ``_source``,
+    so if the ``profile`` excludes any fields from it, we always send the
+    whole document.
+
+    If ``version`` is set, every write carries it as an external version,
+    e.g. the modification time of the file the documents came from.  A
+    write with an older version than the one already in Elasticsearch is
+    rejected, so an older run can't overwrite a newer one, or bring back a
+    document that a newer run has deleted (within ``index.gc_deletes``).
+    Rejected writes are counted as conflicts, not failures.  The update API
+    doesn't support external versions, so partial updates are sent without
+    one -- they can't be rejected as stale.  Runs in this process never
+    overlap (see below), so that only matters if another process writes to
+    the same index.
+
+    Only one call at a time can write to an index in this process; if
+    another call is already running, this returns without doing anything.
+
+    If ``facets`` is a ``taggle.facets.TagFacets``, it's kept in sync with
+    the tags of the documents, for use in ``search_documents``.
+
+    """
+    run = _IndexRun(
+        index_name=index_name,
+        incremental=incremental,
+        doc_type=doc_type,
+        profile=profile,
+        facets=facets,
+        version=version
+    )
+    create_index(
+        client=client,
+        name=index_name,
+        doc_type=run.doc_type,
+        profile=profile
+    )
+
+    bulk_options = dict(
+        chunk_size=chunk_size,
+        max_chunk_bytes=max_chunk_bytes,
+        workers=workers,
+        queue_size=queue_size
+    )
+
+    print('Indexing changed documents...')
+    run.record(_bulk(client, run.index_actions(documents), **bulk_options))
+
+    print('Cleaning up deleted bookmarks...')
+    if run.previous is None:
+        indexed_ids = _indexed_ids(client=client, index_name=index_name)
+    else:
+        indexed_ids = run.previous
+    run.record(_bulk(client, run.delete_actions(indexed_ids), **bulk_options))
+
+    # The index may have a long refresh_interval, so make this run's
+    # changes visible to search straight away.
+    if run.changed:
+        client.indices.refresh(index=index_name)
+    run.finish()
+
+
+class _IndexRun:
+    """The state of one call to ``index_documents`` or
+    ``async_index_documents``, which only differ in how they talk to
+    Elasticsearch.
+    """
+
+    def __init__(self, index_name, incremental, doc_type, profile, facets,
+                 version):
+        self.index_name = index_name
+        self.doc_type = index_name if doc_type is None else doc_type
+        self.profile = profile
+        self.facets = facets
+        self.version = version
+        self.previous = _last_indexed.get(index_name) if incremental else None
+
+        # Documents we fail to write are marked as unknown in the
+        # fingerprints, so an incremental run will send them again -- but
+        # they're still in there, so the sweep doesn't delete them.
+        self.fingerprints = {}
+        self.changed = False
+
+    def index_actions(self, documents):
+        return _index_actions(
+            documents,
+            index_name=self.index_name,
+            doc_type=self.doc_type,
+            previous=self.previous,
+            fingerprints=self.fingerprints,
+            facets=self.facets,
+            partial=not self.profile.source_excludes,
+            version=self.version
+        )
+
+    def delete_actions(self, indexed_ids):
+        return _delete_actions(
+            indexed_ids,
+            index_name=self.index_name,
+            doc_type=self.doc_type,
+            fingerprints=self.fingerprints,
+            facets=self.facets,
+            version=self.version
+        )
+
+    def record(self, result):
+        """Records the (written, failed IDs) result of a bulk load."""
+        written, failed = result
+        if written:
+            self.changed = True
+        for doc_id in failed:
+            self.fingerprints[doc_id] = None
+
+    def finish(self):
+        """Saves the fingerprints for the next run, once the caller has
+        refreshed the index after any writes.
+        """
+        if self.changed:
+            _invalidate(self.index_name)
+        _last_indexed[self.index_name] = self.fingerprints
+
+
+def _index_actions(documents,
+                   index_name,
+                   doc_type,
+                   previous,
+                   fingerprints,
+                   facets,
+                   partial=True,
+                   version=None):
+    """Generates a bulk action for every document that's changed since
+    ``previous``, recording the fingerprint of every document we see.
+
+    If ``partial`` is True, a document where only some fields have changed
+    gets an ``update`` action with just those fields, unless one of them
+    is an object; otherwise, documents are always indexed in full.  Only
+    full ``index`` actions carry the ``version``, because the update API
+    doesn't accept external versions.
+
+    """
+    for doc in documents:
+        if facets is not None:
+            facets.update(doc.id, doc.tags)
+
+        fields = _document_fields(doc)
+        fingerprint = _fingerprint(fields)
+        fingerprints[doc.id] = fingerprint
+
+        if previous is None:
+            changed = None
+        else:
+            changed = _changed_fields(previous.get(doc.id), fingerprint)
+
+        if changed is not None and not changed:
+            continue
+
+        act = {
+            '_index': index_name,
+            '_type': doc_type,
+            '_id': doc.id,
+        }
+
+        # Elasticsearch merges an object in a partial update into the one
+        # it already has, so a key we've removed from it would stay there.
+        if changed is not None and any(
+            isinstance(fields[name], dict) for name in changed
+        ):
+            changed = None
+
+        if partial and changed is not None and len(changed) < len(fields):
+            act['_op_type'] = 'update'
+            act['doc'] = {name: fields[name] for name in changed}
+        else:
+            act['_op_type'] = 'index'
+            act.update(fields)
+            act.update(_version_metadata(version))
+
+        yield act
+
+
+def _delete_actions(indexed_ids,
+                    index_name,
+                    doc_type,
+                    fingerprints,
+                    facets,
+                    version=None):
+    """Generates a bulk action to delete every indexed document that we
+    didn't see in this run.
+    """
+    for doc_id in indexed_ids:
+        if doc_id in fingerprints:
+            continue
+
+        if facets is not None:
+            facets.remove(doc_id)
+
+        act = {
+            '_op_type': 'delete',
+            '_index': index_name,
+            '_type': doc_type,
+            '_id': doc_id,
+        }
+        act.update(_version_metadata(version))
+        yield act
+
+
+def _version_metadata(version):
+    if version is None:
+        return {}
+
+    # external_gte rather than external, so a run can rewrite documents at
+    # the same version, e.g. to retry ones it failed to write.
+    return {'_version': version, '_version_type': 'external_gte'}
+
+
+@_single_flight('index_name')
+async def async_index_documents(client,
+                                index_name,
+                                documents,
+                                incremental=False,
+                                chunk_size=500,
+                                max_chunk_bytes=10 * 1024 * 1024,
+                                doc_type=None,
+                                profile=DEFAULT_PROFILE,
+                                facets=None,
+                                version=None):
+    """Index a series of documents from a coroutine.
+
+    This is ``index_documents`` for an asyncio client, e.g. the
+    ``AsyncElasticsearch`` from elasticsearch-async, and shares its
+    fingerprints -- so incremental runs can mix the two.  Chunks are sent
+    one at a time; the event loop is free while we wait for each of them.
+
+    ``documents`` is still an ordinary iterable, and is read in between
+    chunks, so it shouldn't block for long.
+
+    """
+    run = _IndexRun(
+        index_name=index_name,
+        incremental=incremental,
+        doc_type=doc_type,
+        profile=profile,
+        facets=facets,
+        version=version
+    )
+    await _async_create_index(
+        client,
+        name=index_name,
+        doc_type=run.doc_type,
+        profile=profile
+    )
+
+    bulk_options = dict(chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes)
+
+    print('Indexing changed documents...')
+    run.record(
+        await _async_bulk(client, run.index_actions(documents), **bulk_options)
+    )
 
     print('Cleaning up deleted bookmarks...')
-    indexed = client.search(index=index_name, _source=False, size=10000)
-    hits = indexed['hits']['hits']
-    indexed_ids = [h['_id'] for h in hits]
+    if run.previous is None:
+        delete_actions = (
+            act
+            async for page in _async_indexed_ids(client, index_name)
+            for act in run.delete_actions(page)
+        )
+    else:
+        delete_actions = run.delete_actions(run.previous)
+    run.record(await _async_bulk(client, delete_actions, **bulk_options))
+
+    if run.changed:
+        await client.indices.refresh(index=index_name)
+    run.finish()
+
+
+async def _async_indexed_ids(client, index_name, scroll='5m'):
+    """The asyncio version of ``_indexed_ids``, which generates the IDs a
+    page of the scroll at a time.
+    """
+    resp = await client.search(
+        index=index_name,
+        body={'query': {'match_all': {}}},
+        _source=False,
+        scroll=scroll,
+        size=1000
+    )
+    scroll_id = resp.get('_scroll_id')
+
+    try:
+        while scroll_id and resp['hits']['hits']:
+            yield [hit['_id'] for hit in resp['hits']['hits']]
+
+            resp = await client.scroll(scroll_id=scroll_id, scroll=scroll)
+            scroll_id = resp.get('_scroll_id')
+    finally:
+        if scroll_id:
+            await client.clear_scroll(scroll_id=scroll_id, ignore=(404,))
+
 
-    delete_actions = []
-    document_ids = [doc.id for doc in documents]
-    for i in indexed_ids:
-        if i not in document_ids:
-            delete_actions.append({
-                '_op_type': 'delete',
-                '_index': index_name,
-                '_type': index_name,
-                '_id': i,
-            })
+async def _async_batches(aiterable, size):
+    """The asyncio version of ``_batches``."""
+    batch = []
+    async for item in aiterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-    if delete_actions:
-        resp = bulk_helper(client=client, actions=delete_actions)
 
+async def _async_chunks(actions, chunk_size, max_chunk_bytes, serializer):
+    """Generates the chunks of a bulk load, as built by ``streaming_bulk``.
 
-def _join_dicts(x, y):
-    x.update(y)
-    return x
+    ``actions`` can be an ordinary or an async iterable; either way, we only
+    read one chunk of actions at a time.
+
+    """
+    if hasattr(actions, '__aiter__'):
+        batches = _async_batches(actions, size=chunk_size)
+    else:
+        batches = _as_async(_batches(actions, size=chunk_size))
+
+    async for batch in batches:
+        chunks = _chunk_actions(
+            map(expand_action, batch), chunk_size, max_chunk_bytes, serializer
+        )
+        for chunk in chunks:
+            yield chunk
+
+
+async def _as_async(iterable):
+    for item in iterable:
+        yield item
+
+
+async def _async_bulk(client,
+                      actions,
+                      chunk_size,
+                      max_chunk_bytes,
+                      max_retries=3,
+                      initial_backoff=2,
+                      max_backoff=600):
+    """The asyncio version of ``_bulk``.
+
+    ``actions`` can be an ordinary or an async iterable.  The chunks are
+    built by the same code as ``streaming_bulk``, and chunks or documents
+    rejected with a 429 are retried with the same backoff -- except that we
+    wait with ``asyncio.sleep``, not ``time.sleep``.
+
+    """
+    progress = _BulkProgress(chunk_size=chunk_size)
+    transport_serializer = client.transport.serializer
+
+    chunks = _async_chunks(
+        actions, chunk_size, max_chunk_bytes, transport_serializer
+    )
+
+    async for bulk_data, bulk_actions in chunks:
+        for attempt in range(max_retries + 1):
+            if attempt:
+                await asyncio.sleep(
+                    min(max_backoff, initial_backoff * 2 ** (attempt - 1))
+                )
+
+            try:
+                resp = await client.bulk(body='\n'.join(bulk_actions) + '\n')
+            except TransportError as err:
+                # The cluster rejected the whole request, so send it again.
+                if err.status_code == 429 and attempt < max_retries:
+                    continue
+                raise
+
+            to_retry, to_retry_data = [], []
+            for data, item in zip(bulk_data, resp['items']):
+                _, info = next(iter(item.items()))
+                ok = 200 <= info.get('status', 500) < 300
+
+                if info.get('status') == 429 and attempt < max_retries:
+                    to_retry.extend(
+                        transport_serializer.dumps(d) for d in data
+                    )
+                    to_retry_data.append(data)
+                else:
+                    progress.record(ok, item)
+
+            if not to_retry:
+                break
+            bulk_actions, bulk_data = to_retry, to_retry_data
+
+    return progress.finish()
+
+
+@_single_flight('alias')
+def reindex(client, alias, documents, profile=DEFAULT_PROFILE, **kwargs):
+    """Rebuild an index from scratch, without affecting searches.
+
+    The documents are written into a new, timestamped index, which is then
+    swapped in behind ``alias`` in a single atomic update -- until then,
+    searches against the alias see the old index, not a half-built one.
+    Any other keyword arguments are passed to ``index_documents``.
+
+    Refreshes are disabled and replicas are set to zero while we load the
+    new index, which makes the bulk load much faster; both are restored
+    before the swap.  This is also how to apply a new ``profile`` to an
+    existing index.
+
+    If there's an old-style index named ``alias`` (rather than an alias),
+    it's replaced by the alias.
+
+    """
+    new_index = f'{alias}-{time.strftime("%Y%m%d%H%M%S", time.gmtime())}'
+
+    if client.indices.exists_alias(name=alias):
+        old_indices = list(client.indices.get_alias(name=alias))
+        legacy_index = None
+    elif client.indices.exists(index=alias):
+        old_indices = []
+        legacy_index = alias
+    else:
+        old_indices = []
+        legacy_index = None
+
+    # Keep the replica count of the live index, or go back to the
+    # cluster default if there isn't one.
+    live_indices = old_indices + ([legacy_index] if legacy_index else [])
+    if live_indices:
+        live_settings = client.indices.get_settings(index=live_indices[0])
+        index_settings = live_settings[live_indices[0]]['settings']['index']
+        replicas = index_settings['number_of_replicas']
+    else:
+        replicas = None
+
+    print(f'Building new index {new_index}...')
+    create_index(
+        client=client,
+        name=new_index,
+        doc_type=alias,
+        settings={'refresh_interval': '-1', 'number_of_replicas': 0},
+        profile=profile
+    )
+    index_documents(
+        client=client,
+        index_name=new_index,
+        documents=documents,
+        doc_type=alias,
+        profile=profile,
+        **kwargs
+    )
+
+    client.indices.put_settings(
+        index=new_index,
+        body={
+            'index': {
+                'refresh_interval': profile.refresh_interval,
+                'number_of_replicas': replicas,
+            }
+        }
+    )
+    client.indices.refresh(index=new_index)
+
+    print(f'Swapping {alias} to point to {new_index}...')
+    actions = [{'add': {'index': new_index, 'alias': alias}}]
+    for name in old_indices:
+        actions.append({'remove': {'index': name, 'alias': alias}})
+    if legacy_index is not None:
+        actions.append({'remove_index': {'index': legacy_index}})
+    client.indices.update_aliases(body={'actions': actions})
+
+    for name in old_indices:
+        client.indices.delete(index=name)
+
+    _invalidate(alias)
+
+    # Incremental updates now go through the alias, and should pick up
+    # from the documents we've just written.
+    _last_indexed[alias] = _last_indexed.pop(new_index)
+
+
+# Search results are cached in-process for a short while.  Every write
+# to an index bumps its generation, which is part of the cache key, so
+# results from before the write are never served after it -- the TTL
+# only matters if the index is written to by another process.
+_search_cache = LRUCache(max_entries=1024, max_bytes=64 * 1024 * 1024, ttl=60)
+
+# The tag cloud is the same for every page of a query, so we cache it
+# separately from the pages themselves.
+_tag_cache = LRUCache(max_entries=1024, ttl=60)
+_generations = collections.Counter()
+_generations_lock = threading.Lock()
+
+
+def _invalidate(index_name):
+    """Mark any cached search results for an index as stale."""
+    with _generations_lock:
+        _generations[index_name] += 1
+
+
+def _encode_cursor(direction, sort_values):
+    """Encode the sort values of a hit as an opaque, URL-safe cursor."""
+    data = json.dumps([direction, sort_values]).encode('utf8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def _decode_cursor(cursor):
+    """Decode a cursor from ``_encode_cursor``.  Returns None if it isn't
+    a valid cursor, e.g. if somebody has edited the URL.
+    """
+    try:
+        direction, sort_values = json.loads(base64.urlsafe_b64decode(cursor))
+    except (TypeError, ValueError):
+        return None
+
+    if direction not in ('after', 'before'):
+        return None
+
+    if not isinstance(sort_values, list):
+        return None
+
+    return direction, sort_values
+
+
+@attr.s
+class _SearchRequest:
+    """Everything we need to run a search and build its ``ResultList``.
+
+    ``body`` is the search for the page of documents.  ``tag_body`` is the
+    aggregation for the tag counts, or None if we already have them in
+    ``tags``.  If the whole result was in the cache, it's in ``cached``.
+
+    """
+    index_name = attr.ib()
+    page = attr.ib()
+    page_size = attr.ib()
+    cursor = attr.ib()
+    use_cache = attr.ib()
+    cache_key = attr.ib()
+    tag_cache_key = attr.ib()
+    body = attr.ib(default=None)
+    tag_body = attr.ib(default=None)
+    tags = attr.ib(default=None)
+    cached = attr.ib(default=None)
+
+
+def _prepare_search(index_name,
+                    query_string,
+                    query_params=None,
+                    page=1,
+                    page_size=96,
+                    cursor=None,
+                    use_cache=True,
+                    facets=None,
+                    profile=DEFAULT_PROFILE):
+    """Work out the requests for a search, without sending them."""
+    source_filter = profile.source_filter()
+
+    tag_cache_key = (
+        index_name,
+        _generations[index_name],
+        compile_query(query_string),
+    )
+    cache_key = tag_cache_key + (
+        page,
+        page_size,
+        cursor,
+        json.dumps([source_filter, query_params], sort_keys=True),
+    )
+
+    request = _SearchRequest(
+        index_name=index_name,
+        page=page,
+        page_size=page_size,
+        cursor=None,
+        use_cache=use_cache,
+        cache_key=cache_key,
+        tag_cache_key=tag_cache_key
+    )
+
+    if use_cache:
+        request.cached = _search_cache.get(cache_key)
+        if request.cached is not None:
+            return request
+
+    if cursor is not None:
+        request.cursor = _decode_cursor(cursor)
+
+    request.body = _build_query(
+        query_string=query_string,
+        page=page,
+        page_size=page_size,
+        cursor=request.cursor
+    )
+
+    if source_filter is not None:
+        request.body['_source'] = source_filter
+
+    if query_params is not None:
+        request.body.update(query_params)
+
+    plan = compile_query(query_string)
+    if facets and plan.is_filter_only:
+        request.tags = facets.top_tags(plan.tags)
+    elif use_cache:
+        request.tags = _tag_cache.get(tag_cache_key)
+
+    if request.tags is None:
+        request.tag_body = _build_tag_query(query_string=query_string)
+
+    return request
+
+
+def _finish_search(request, resp, tag_resp=None):
+    """Build (and cache) the ``ResultList`` for a search, given the
+    response to its ``body``, and to its ``tag_body`` if it had one.
+    """
+    if tag_resp is None:
+        tags = request.tags
+    else:
+        tags = {
+            bucket['key']: bucket['doc_count']
+            for bucket in tag_resp['aggregations']['tags']['buckets']
+        }
+        if request.use_cache:
+            _tag_cache.set(request.tag_cache_key, tags)
+
+    page = request.page
+    page_size = request.page_size
+    total_size = resp['hits']['total']
+    hits = resp['hits']['hits']
+
+    # When we page backwards, the query runs in reverse order.
+    if request.cursor is not None and request.cursor[0] == 'before':
+        hits.reverse()
+
+    if hits and page * page_size < total_size:
+        next_cursor = _encode_cursor('after', hits[-1]['sort'])
+    else:
+        next_cursor = None
+
+    if hits and page > 1:
+        prev_cursor = _encode_cursor('before', hits[0]['sort'])
+    else:
+        prev_cursor = None
+
+    if request.use_cache:
+        size = _estimated_size(hits)
+
+    results = ResultList(
+        total_size=total_size,
+        documents=LazyDocuments(hits),
+        page=page,
+        page_size=page_size,
+        tags=tags,
+        next_cursor=next_cursor,
+        prev_cursor=prev_cursor
+    )
+
+    if request.use_cache:
+        _search_cache.set(request.cache_key, results, size=size)
+
+    return results
+
+
+def _estimated_size(hits):
+    """Returns a rough size for a page of hits, in bytes.
+
+    Hits on a page tend to be much the same size, so we measure the first
+    one rather than encoding the whole page.  This has to happen before
+    the documents are built, which consumes the hits.
+
+    """
+    if not hits:
+        return 0
+    return len(serializer.dumps(hits[0])) * len(hits)
 
 
 def search_documents(client,
@@ -125,99 +1140,246 @@ def search_documents(client,
                      query_string,
                      query_params=None,
                      page=1,
-                     page_size=96):
-    body = _build_query(
+                     page_size=96,
+                     cursor=None,
+                     use_cache=True,
+                     facets=None,
+                     profile=DEFAULT_PROFILE):
+    """Search an Elasticsearch index, and return a ``ResultList``.
+
+    If ``cursor`` is one of the cursors from a previous ``ResultList``, we
+    fetch the page next to that one with ``search_after``, which costs the
+    same however deep the page is.  Otherwise we fetch ``page`` by offset.
+    In both cases, ``page`` is the number of the page being fetched.
+
+    Results are cached, keyed on the compiled query, until the next
+    write to the index (or for a minute).  Pass ``use_cache=False`` to
+    always go to Elasticsearch.
+
+    The tag counts come from a separate aggregation request, which is
+    cached for all the pages of a query.  If we need it, it's sent in the
+    same ``_msearch`` as the request for the documents.  If ``facets`` is
+    a ``taggle.facets.TagFacets`` that's been passed to ``index_documents``,
+    and the query only filters on tags, we count the tags locally instead.
+
+    Only the ``listing_fields`` of the ``profile`` are fetched, and the
+    documents are built from the hits as they're read.  Anything in
+    ``query_params`` overrides both of these.
+
+    """
+    request = _prepare_search(
+        index_name=index_name,
         query_string=query_string,
+        query_params=query_params,
         page=page,
-        page_size=page_size
+        page_size=page_size,
+        cursor=cursor,
+        use_cache=use_cache,
+        facets=facets,
+        profile=profile
     )
+    if request.cached is not None:
+        return request.cached
 
-    if query_params is not None:
-        body.update(query_params)
+    if request.tag_body is None:
+        resp = client.search(index=index_name, body=request.body)
+        return _finish_search(request, resp)
 
-    resp = client.search(index=index_name, body=body)
+    resp, tag_resp = _msearch(
+        client=client,
+        index_name=index_name,
+        bodies=[request.body, request.tag_body]
+    )
+    return _finish_search(request, resp, tag_resp)
 
-    total_size = resp['hits']['total']
-    documents = [
-        TaggedDocument(**_join_dicts(doc['_source'], {'id': doc['_id']}))
-        for doc in resp['hits']['hits']
-    ]
-
-    aggregations = resp['aggregations']
-    tags = {
-        bucket['key']: bucket['doc_count']
-        for bucket in aggregations['tags']['buckets']
-    }
 
-    return ResultList(
-        total_size=total_size,
-        documents=documents,
+def search_many(client,
+                index_name,
+                queries,
+                use_cache=True,
+                facets=None,
+                profile=DEFAULT_PROFILE):
+    """Run several searches against an index in one round trip, and return
+    a ``ResultList`` for each of them, in order.
+
+    Each query is either a query string, or a dict of the keyword arguments
+    to ``search_documents`` -- e.g. ``{'query_string': 'tags:x', 'page': 2}``
+    -- which override ``use_cache``, ``facets`` and ``profile``.
+
+    Anything that isn't cached is sent in a single ``_msearch``.  Queries
+    that only differ by page share one tag aggregation.
+
+    """
+    requests = []
+    for query in queries:
+        if isinstance(query, str):
+            query = {'query_string': query}
+        options = {
+            'use_cache': use_cache,
+            'facets': facets,
+            'profile': profile,
+        }
+        options.update(query)
+        requests.append(_prepare_search(index_name=index_name, **options))
+
+    # Where each request's responses will be in the _msearch.
+    bodies = []
+    positions = []
+    tag_positions = {}
+    for request in requests:
+        if request.cached is not None:
+            positions.append(None)
+            continue
+
+        positions.append(len(bodies))
+        bodies.append(request.body)
+
+        if (
+            request.tag_body is not None and
+            request.tag_cache_key not in tag_positions
+        ):
+            tag_positions[request.tag_cache_key] = len(bodies)
+            bodies.append(request.tag_body)
+
+    if bodies:
+        responses = _msearch(
+            client=client, index_name=index_name, bodies=bodies
+        )
+
+    results = []
+    for request, position in zip(requests, positions):
+        if position is None:
+            results.append(request.cached)
+            continue
+
+        if request.tag_body is None:
+            tag_resp = None
+        else:
+            tag_resp = responses[tag_positions[request.tag_cache_key]]
+
+        results.append(_finish_search(request, responses[position], tag_resp))
+
+    return results
+
+
+async def async_search_documents(client,
+                                 index_name,
+                                 query_string,
+                                 query_params=None,
+                                 page=1,
+                                 page_size=96,
+                                 cursor=None,
+                                 use_cache=True,
+                                 facets=None,
+                                 profile=DEFAULT_PROFILE):
+    """Search an Elasticsearch index from a coroutine.
+
+    This is ``search_documents`` for an asyncio client, e.g. the
+    ``AsyncElasticsearch`` from elasticsearch-async, and takes the same
+    arguments.  The event loop is free to serve other requests while we
+    wait for Elasticsearch.
+
+    """
+    request = _prepare_search(
+        index_name=index_name,
+        query_string=query_string,
+        query_params=query_params,
         page=page,
         page_size=page_size,
-        tags=tags
+        cursor=cursor,
+        use_cache=use_cache,
+        facets=facets,
+        profile=profile
+    )
+    if request.cached is not None:
+        return request.cached
+
+    if request.tag_body is None:
+        resp = await client.search(index=index_name, body=request.body)
+        return _finish_search(request, resp)
+
+    resp = await client.msearch(
+        body=_msearch_body(index_name, [request.body, request.tag_body])
     )
+    resp, tag_resp = _msearch_responses(resp)
+    return _finish_search(request, resp, tag_resp)
 
 
-def _build_query(query_string, page, page_size):
+def _build_query(query_string, page, page_size, cursor=None):
     """Search an Elasticsearch index."""
+    plan = compile_query(query_string)
+
     # These parameters can be set irrespective of the query string.
     # Note: 'from' is an offset parameter, and is 0-indexed.
     query = {
-        'from': (page - 1) * page_size,
         'size': page_size,
+        'query': _render_query(plan),
     }
 
-    def _is_filter(token):
-        return _is_tag(token)
+    if cursor is None:
+        query['from'] = (page - 1) * page_size
+    else:
+        direction, sort_values = cursor
+        query['search_after'] = sort_values
 
-    def _is_tag(token):
-        return token.startswith('tags:')
+    # Every query has a total order -- newest first, or by relevance for
+    # free-text searches -- with the ID as a tie-breaker, so the sort
+    # values of a hit can be used as a search_after cursor.
+    if plan.is_filter_only:
+        sort = [{'date_added': 'desc'}, {'doc_id': 'desc'}]
+    else:
+        sort = [{'_score': 'desc'}, {'date_added': 'desc'}, {'doc_id': 'desc'}]
 
-    query_string = query_string.strip()
+    # To get the page before a cursor, we run the query in reverse.
+    if cursor is not None and direction == 'before':
+        sort = [
+            {field: 'asc' if order == 'desc' else 'desc'}
+            for clause in sort
+            for field, order in clause.items()
+        ]
 
-    # Attempt to split the query string into tokens, but don't try too hard.
-    # If it fails, we shouldn't error here --- better for it to error when it
-    # hits Elasticsearch, if at all.
-    try:
-        tokens = shlex.split(query_string)
-    except ValueError:
-        tokens = [query_string]
+    query['sort'] = sort
+
+    return query
 
-    if not query_string or all(_is_filter(t) for t in tokens):
-        query['sort'] = [{'date_added': 'desc'}]
 
-    query['query'] = {'bool': {'filter': []}}
-    bool_conditions = query['query']['bool']
+@functools.lru_cache(maxsize=1024)
+def _render_query(plan):
+    """Turn a ``QueryPlan`` into the 'query' clause of a search.
+
+    This is the same for every page of a query, so we only build it once.
+    The result is shared between searches, so don't modify it!
+
+    """
+    bool_conditions = {'filter': []}
 
     # If there are any fields which don't get replaced as tag filters,
     # add them with the simple_query_string syntax.
-    simple_qs = ' '.join(t for t in tokens if not _is_filter(t))
-    if simple_qs:
+    if plan.free_text:
         bool_conditions['must'] = {
-            'query_string': {'query': simple_qs}
+            'query_string': {'query': plan.free_text}
         }
 
-    # Any tags get added as explicit "this must match" fields.
-    tag_tokens = [t for t in tokens if _is_tag(t)]
-    tags = [t.split(':', 1)[-1] for t in tag_tokens]
-    if tags:
-        bool_conditions['filter'].append({
-            'terms_set': {
-                'tags.raw': {
-                    'terms': tags,
-
-                    # This tells Elasticsearch: every term should match!
-                    'minimum_should_match_script': {
-                        'source': 'params.num_terms'
-                    }
-                }
-            }
-        })
+    # Any tags get added as explicit "this must match" fields.  We use
+    # one term filter per tag, rather than a single terms_set that runs a
+    # script on every candidate document -- term filters are cheap, and
+    # Elasticsearch can cache each one and reuse it across queries.
+    for tag in plan.tags:
+        bool_conditions['filter'].append({'term': {'tags.raw': tag}})
 
     if not bool_conditions['filter']:
         del bool_conditions['filter']
 
-    # We always ask for an aggregation on tags.raw (which is a keyword field,
+    return {'bool': bool_conditions}
+
+
+def _build_tag_query(query_string):
+    """Build a query that only fetches the tag counts for a query string."""
+    query = _build_query(query_string=query_string, page=1, page_size=0)
+    del query['from']
+    del query['sort']
+
+    # We ask for an aggregation on tags.raw (which is a keyword field,
     # unlike the free-text field we can't aggregate), which is used to display
     # the contextual tag cloud.
     query['aggregations'] = {
@@ -232,6 +1394,40 @@ def _build_query(query_string, page, page_size):
     return query
 
 
+def _msearch_body(index_name, bodies):
+    request = []
+    for body in bodies:
+        request.extend([{'index': index_name}, body])
+    return request
+
+
+def _msearch_responses(resp):
+    """Unpack the responses from an ``_msearch``, raising the first error,
+    just as ``client.search`` would.
+    """
+    responses = resp['responses']
+
+    for resp in responses:
+        if 'error' in resp:
+            raise TransportError(
+                resp.get('status', 500), resp['error']['type'], resp['error']
+            )
+
+    return responses
+
+
+def _msearch(client, index_name, bodies):
+    """Run several searches against an index in a single ``_msearch``
+    request, and return the responses in order.
+
+    Elasticsearch runs the searches in parallel.  If any of them fails, we
+    raise the error, just as ``client.search`` would.
+
+    """
+    resp = client.msearch(body=_msearch_body(index_name, bodies))
+    return _msearch_responses(resp)
+
+
 def add_tag_to_query(query_string, new_tag):
     """Given a query in Elasticsearch's query string syntax, add another tag
     to further filter the query.
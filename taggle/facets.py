@@ -0,0 +1,270 @@
+# -*- encoding: utf-8
+"""Count the tags in a set of documents, for the contextual tag cloud.
+
+Every document gets a small integer ordinal, and for every tag we keep a
+sorted array of the ordinals of the documents with that tag.  To count
+tags in a result set, we turn the arrays into bitmaps (Python ints, with
+bit N set if document N has the tag) and intersect them with a bitmap of
+the results.
+
+"""
+
+import array
+import bisect
+import collections
+import heapq
+import threading
+
+
+def popcount(bitmap):
+    return bin(bitmap).count('1')
+
+
+def to_bitmap(ordinals):
+    """Build a bitmap from a sorted sequence of ordinals."""
+    if not len(ordinals):
+        return 0
+
+    data = bytearray(ordinals[-1] // 8 + 1)
+    for ordinal in ordinals:
+        data[ordinal >> 3] |= 1 << (ordinal & 7)
+    return int.from_bytes(data, 'little')
+
+
+def iter_ordinals(bitmap):
+    """Generates the positions of the set bits in a bitmap, lowest first."""
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+    for idx, byte in enumerate(data):
+        while byte:
+            lowest = byte & -byte
+            yield idx * 8 + lowest.bit_length() - 1
+            byte ^= lowest
+
+
+def contains(data, ordinal):
+    """Checks if a bit is set, given the bitmap as little-endian bytes."""
+    idx = ordinal >> 3
+    return idx < len(data) and data[idx] >> (ordinal & 7) & 1
+
+
+class _Descending:
+    """Wraps a value so it sorts in reverse order."""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return self.value > other.value
+
+
+# If a result set is smaller than this, it's cheaper to count the tags on
+# each document than to intersect bitmaps.
+SMALL_RESULT_SIZE = 1024
+
+
+class FacetIndex:
+    """Maps terms to the ordinals of the documents that contain them.
+
+    The postings for each term are a sorted sequence of ordinals -- an
+    ``array`` normally, but anything that supports ``len``, indexing and
+    iteration will do, e.g. a ``memoryview`` of a file.  Bitmaps are built
+    from them on demand, and cached until the term changes.
+
+    This class isn't thread-safe on its own; callers should hold a lock.
+
+    """
+
+    def __init__(self, postings=None):
+        self._postings = postings if postings is not None else {}
+        self._bitmaps = {}
+
+        # All the terms, most documents first.  Rebuilt after a write.
+        self._by_size = None
+
+    def __len__(self):
+        return len(self._postings)
+
+    def __iter__(self):
+        return iter(self._postings)
+
+    def add(self, ordinal, terms):
+        for term in set(terms):
+            postings = self._postings.get(term)
+            if not isinstance(postings, array.array):
+                postings = array.array('I', postings or ())
+                self._postings[term] = postings
+
+            if not postings or postings[-1] < ordinal:
+                postings.append(ordinal)
+            else:
+                idx = bisect.bisect_left(postings, ordinal)
+                if idx == len(postings) or postings[idx] != ordinal:
+                    postings.insert(idx, ordinal)
+
+            self._bitmaps.pop(term, None)
+
+        self._by_size = None
+
+    def remove(self, ordinal, terms):
+        for term in set(terms):
+            postings = self._postings.get(term)
+            if postings is None:
+                continue
+            if not isinstance(postings, array.array):
+                postings = array.array('I', postings)
+                self._postings[term] = postings
+
+            idx = bisect.bisect_left(postings, ordinal)
+            if idx < len(postings) and postings[idx] == ordinal:
+                del postings[idx]
+            if not postings:
+                del self._postings[term]
+
+            self._bitmaps.pop(term, None)
+
+        self._by_size = None
+
+    def count(self, term):
+        return len(self._postings.get(term, ()))
+
+    def bitmap(self, term):
+        try:
+            return self._bitmaps[term]
+        except KeyError:
+            bitmap = to_bitmap(self._postings.get(term, ()))
+            self._bitmaps[term] = bitmap
+            return bitmap
+
+    def matching(self, terms, within):
+        """Returns a bitmap of the documents in ``within`` that contain all
+        of ``terms``.
+        """
+        result = within
+        for term in terms:
+            result &= self.bitmap(term)
+        return result
+
+    def top_terms(self, result, size=200, terms_of=None):
+        """Returns the ``size`` terms that occur most often in the documents
+        in ``result``, with their counts, most common first.
+
+        We look at terms in order of how many documents they have overall,
+        which is an upper bound on their count in the results -- so once
+        that bound drops below the counts we already have, we can stop.
+
+        If ``terms_of`` is a function that returns the terms for a given
+        ordinal, small result sets are counted document-by-document.  As
+        with the bitmaps, a term counts once per document, however many
+        times the document lists it.
+
+        """
+        if terms_of is not None and popcount(result) < SMALL_RESULT_SIZE:
+            counter = collections.Counter()
+            for ordinal in iter_ordinals(result):
+                counter.update(set(terms_of(ordinal)))
+            top = counter.items()
+        else:
+            if self._by_size is None:
+                self._by_size = sorted(
+                    self._postings,
+                    key=lambda t: len(self._postings[t]),
+                    reverse=True
+                )
+
+            # A min-heap of the terms we're keeping, so the worst one --
+            # the lowest count, then the last alphabetically -- is always
+            # at the front.
+            heap = []
+            for term in self._by_size:
+                if len(heap) == size and self.count(term) < heap[0][0]:
+                    break
+
+                count = popcount(self.bitmap(term) & result)
+                if not count:
+                    continue
+
+                entry = (count, _Descending(term))
+                if len(heap) < size:
+                    heapq.heappush(heap, entry)
+                elif heap[0] < entry:
+                    heapq.heapreplace(heap, entry)
+
+            top = ((term.value, count) for count, term in heap)
+
+        # Match the order of a terms aggregation: by count, then by term.
+        ordered = sorted(top, key=lambda tc: (-tc[1], tc[0]))
+        return dict(ordered[:size])
+
+
+class TagFacets:
+    """Tag counts for a set of documents, kept up to date as they're
+    indexed.
+
+    Pass one to ``taggle.elastic.index_documents`` and
+    ``search_documents``, and the tag cloud for a query that only filters
+    on tags is computed here, without an aggregation in Elasticsearch.
+
+    """
+
+    def __init__(self):
+        self._index = FacetIndex()
+        self._ordinals = {}
+        self._tags = []
+        self._live = 0
+
+        # Ordinals freed by deleted documents, which we reuse so the
+        # bitmaps stay as short as possible.
+        self._free = []
+
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return '<%s documents=%d>' % (type(self).__name__, len(self))
+
+    def __len__(self):
+        return len(self._ordinals)
+
+    def update(self, doc_id, tags):
+        with self._lock:
+            ordinal = self._ordinals.get(doc_id)
+            if ordinal is not None:
+                if self._tags[ordinal] == tuple(tags):
+                    return
+                self.remove(doc_id)
+
+            if self._free:
+                ordinal = heapq.heappop(self._free)
+            else:
+                ordinal = len(self._tags)
+                self._tags.append(None)
+
+            self._ordinals[doc_id] = ordinal
+            self._tags[ordinal] = tuple(tags)
+            self._live |= 1 << ordinal
+            self._index.add(ordinal, tags)
+
+    def remove(self, doc_id):
+        with self._lock:
+            ordinal = self._ordinals.pop(doc_id, None)
+            if ordinal is None:
+                return
+
+            self._index.remove(ordinal, self._tags[ordinal])
+            self._tags[ordinal] = None
+            self._live &= ~(1 << ordinal)
+            heapq.heappush(self._free, ordinal)
+
+    def top_tags(self, tags=(), size=200):
+        """Returns the ``size`` most common tags on the documents that have
+        all of ``tags``, with their counts.
+        """
+        with self._lock:
+            result = self._index.matching(tags, within=self._live)
+            return self._index.top_terms(
+                result, size=size, terms_of=self._tags.__getitem__
+            )
@@ -4,12 +4,13 @@ import datetime as dt
 import os
 from urllib.parse import urlparse
 
-from flask import Flask, url_for
+from flask import Flask, render_template, url_for
 from flask_scss import Scss
-from jinja2 import StrictUndefined
+from jinja2 import Markup, StrictUndefined
 import maya
 
 from taggle.elastic import add_tag_to_query
+from taggle.tagcloud import render_tag_cloud
 
 
 def TaggleApp(name, instance_path):
@@ -38,22 +39,51 @@ def TaggleApp(name, instance_path):
 
 
 
-def _build_pagination_url(request, desired_page):
+def _build_pagination_url(request, desired_page, cursor):
     if desired_page < 1:
         return None
     args = request.args.copy()
     args['page'] = desired_page
+
+    # Page 1 doesn't need a cursor, and is more likely to be cached
+    # without one.
+    if cursor is None or desired_page == 1:
+        args.pop('cursor', None)
+    else:
+        args['cursor'] = cursor
     return url_for(request.endpoint, **args)
 
 
-def next_page_url(request):
+def next_page_url(request, results):
     page = int(request.args.get('page', '1'))
-    return _build_pagination_url(request, desired_page=page + 1)
+    return _build_pagination_url(
+        request, desired_page=page + 1, cursor=results.next_cursor)
 
 
-def prev_page_url(request):
+def prev_page_url(request, results):
     page = int(request.args.get('page', '1'))
-    return _build_pagination_url(request, desired_page=page - 1)
+    return _build_pagination_url(
+        request, desired_page=page - 1, cursor=results.prev_cursor)
+
+
+def tag_cloud_filter(options, template='_tag_cloud.html'):
+    """Returns a Jinja filter that renders a tag cloud from a set of tag
+    counts, e.g. ``{{ results.tags|tag_cloud(query_string) }}``.
+
+    The template gets the ``tag_cloud`` and the ``query_string``, and the
+    HTML is cached by ``taggle.tagcloud.render_tag_cloud``.
+
+    """
+    def _tag_cloud(counter, query_string):
+        def _render(tag_cloud):
+            return render_template(
+                template, tag_cloud=tag_cloud, query_string=query_string)
+
+        return Markup(render_tag_cloud(
+            counter, options, query_string, render=_render, template=template
+        ))
+
+    return _tag_cloud
 
 
 def generation_time(start_time):
@@ -0,0 +1,326 @@
+# -*- encoding: utf-8
+"""An in-process alternative to ``taggle.elastic``.
+
+For a personal-sized corpus, the searches we run -- filter on a set of
+tags, match some free text, count the tags in the results -- are cheap
+enough to do in Python, without a cluster to run.
+
+Each tag and each word maps to the documents that contain it, in a
+``FacetIndex``, which gives us a bitmap of those documents as a Python int
+(bit N is set if document N matches).  A multi-tag filter is then a
+bitwise AND, and the number of matches is a popcount.
+
+"""
+
+import collections
+import re
+import threading
+
+from taggle.facets import contains, FacetIndex, iter_ordinals, popcount
+from taggle.models import ResultList
+from taggle.query import compile_query
+from taggle.snapshot import read_snapshot, write_snapshot
+
+
+def _words(text):
+    return set(re.findall(r'\w+', text.lower()))
+
+
+def _document_words(doc):
+    """Returns all the words we can match against in a document: its tags,
+    and any string in its metadata.
+    """
+    words = set()
+    for tag in doc.tags:
+        words.update(_words(tag))
+    for value in doc.metadata.values():
+        if isinstance(value, str):
+            words.update(_words(value))
+    return words
+
+
+class MemoryIndex:
+    """A search index held entirely in memory.
+
+    Documents are numbered with ordinals in the order they're added.  When
+    a document changes, it gets a new ordinal and the old one is marked
+    as deleted; once more than half the ordinals are deleted, we rebuild
+    the index to reclaim the space.
+
+    An index can be saved to a snapshot file with ``save``, and loaded from
+    one with ``load``.
+
+    """
+
+    def __init__(self):
+        self._ordinals = {}
+        self._documents = []
+        self._sort_keys = []
+        self._live = 0
+
+        self._tags = FacetIndex()
+        self._words = FacetIndex()
+
+        # Ordinals of the live documents, newest first.  This is rebuilt
+        # lazily after a write.
+        self._date_order = None
+
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return '<%s documents=%d>' % (type(self).__name__, len(self))
+
+    def __len__(self):
+        return len(self._ordinals)
+
+    def index_documents(self, documents):
+        """Replace the contents of the index with ``documents``.
+
+        Documents that haven't changed are left alone, and any documents
+        that aren't in ``documents`` are deleted.
+
+        """
+        seen = set()
+        for doc in documents:
+            seen.add(doc.id)
+            ordinal = self._ordinals.get(doc.id)
+            if ordinal is not None and self._documents[ordinal] == doc:
+                continue
+            self._add(doc)
+
+        for doc_id in list(self._ordinals):
+            if doc_id not in seen:
+                self._delete(doc_id)
+
+        if len(self._documents) > 2 * len(self._ordinals):
+            self._rebuild()
+
+    def _add(self, doc):
+        with self._lock:
+            self._delete(doc.id)
+
+            ordinal = len(self._documents)
+            self._documents.append(doc)
+            self._sort_keys.append((str(doc.date_added), doc.id))
+            self._ordinals[doc.id] = ordinal
+            self._live |= 1 << ordinal
+
+            self._tags.add(ordinal, doc.tags)
+            self._words.add(ordinal, _document_words(doc))
+
+            self._date_order = None
+
+    def _delete(self, doc_id):
+        # We remove the document from the tags, so the tag counts stay
+        # exact, but we only clear the live bit for the words -- every
+        # search is intersected with the live documents, so stale bits
+        # don't matter, and it saves us re-reading the text.
+        with self._lock:
+            ordinal = self._ordinals.pop(doc_id, None)
+            if ordinal is None:
+                return
+
+            self._tags.remove(ordinal, self._documents[ordinal].tags)
+            self._documents[ordinal] = None
+            self._live &= ~(1 << ordinal)
+            self._date_order = None
+
+    def _rebuild(self):
+        fresh = MemoryIndex()
+        for doc in self._documents:
+            if doc is not None:
+                fresh._add(doc)
+
+        with self._lock:
+            self._ordinals = fresh._ordinals
+            self._documents = fresh._documents
+            self._sort_keys = fresh._sort_keys
+            self._live = fresh._live
+            self._tags = fresh._tags
+            self._words = fresh._words
+            self._date_order = None
+
+    def _sort_key(self, ordinal):
+        return self._sort_keys[ordinal]
+
+    def save(self, path):
+        """Write a snapshot of the index to ``path``.
+
+        Only the live documents are saved, numbered newest first.
+        """
+        with self._lock:
+            live = sorted(
+                self._ordinals.values(), key=self._sort_key, reverse=True
+            )
+            renumbered = {old: new for new, old in enumerate(live)}
+
+            def _postings(facet_index):
+                postings = {}
+                for term in facet_index:
+                    bitmap = facet_index.bitmap(term) & self._live
+                    if bitmap:
+                        postings[term] = sorted(
+                            renumbered[o] for o in iter_ordinals(bitmap)
+                        )
+                return postings
+
+            write_snapshot(
+                path,
+                documents=[self._documents[o] for o in live],
+                tags=_postings(self._tags),
+                words=_postings(self._words)
+            )
+
+    @classmethod
+    def load(cls, path):
+        """Load an index from a snapshot written by ``save``.
+
+        The file is mmap'd, and documents are only decoded when a search
+        returns them.  The index can still be written to, but those
+        changes are held in memory and not written back to the file.
+
+        """
+        snapshot = read_snapshot(path)
+
+        index = cls()
+        index._ordinals = {
+            doc_id: ordinal for ordinal, doc_id in enumerate(snapshot.ids)
+        }
+        index._documents = snapshot.documents
+        index._sort_keys = list(zip(snapshot.dates, snapshot.ids))
+        index._live = (1 << len(snapshot.ids)) - 1
+        index._tags = FacetIndex(postings=snapshot.tags)
+        index._words = FacetIndex(postings=snapshot.words)
+
+        # Snapshots are numbered newest first.
+        index._date_order = list(range(len(snapshot.ids)))
+
+        return index
+
+    def search(self, query_string, page=1, page_size=96):
+        """Search the index, and return a ``ResultList``.
+
+        Tag filters work as in Elasticsearch.  Free text is treated as a
+        bag of words: a document matches if it contains any of them, and
+        documents that match more words are ranked higher.
+
+        """
+        plan = compile_query(query_string)
+
+        with self._lock:
+            result = self._tags.matching(plan.tags, within=self._live)
+
+            words = _words(plan.free_text)
+            if words:
+                matches = [self._words.bitmap(w) & result for w in words]
+                result = 0
+                for bitmap in matches:
+                    result |= bitmap
+
+            total_size = popcount(result)
+            start = (page - 1) * page_size
+
+            if words:
+                scores = collections.Counter()
+                for bitmap in matches:
+                    scores.update(iter_ordinals(bitmap))
+                ranked = sorted(
+                    scores,
+                    key=lambda o: (scores[o], self._sort_key(o)),
+                    reverse=True
+                )
+                page_ordinals = ranked[start:start + page_size]
+            else:
+                page_ordinals = self._newest_first(result, start, page_size)
+
+            documents = [self._documents[o] for o in page_ordinals]
+            tags = self._tags.top_terms(
+                result, terms_of=lambda o: self._documents[o].tags
+            )
+
+        return ResultList(
+            total_size=total_size,
+            page=page,
+            page_size=page_size,
+            documents=documents,
+            tags=tags
+        )
+
+    def _newest_first(self, result, start, count):
+        """Returns ``count`` ordinals from ``result``, newest first, skipping
+        the first ``start`` of them.
+        """
+        if self._date_order is None:
+            self._date_order = sorted(
+                iter_ordinals(self._live), key=self._sort_key, reverse=True
+            )
+
+        # We walk the documents in date order until we've found enough
+        # that are in the result set, so we never sort the results.
+        data = result.to_bytes((result.bit_length() + 7) // 8, 'little')
+        matched = []
+        for ordinal in self._date_order:
+            if contains(data, ordinal):
+                matched.append(ordinal)
+                if len(matched) == start + count:
+                    break
+
+        return matched[start:]
+
+
+class MemoryClient:
+    """Holds a set of named ``MemoryIndex`` instances.
+
+    This plays the part of the Elasticsearch client in ``index_documents``
+    and ``search_documents``, so the viewers can use either backend.
+
+    """
+
+    def __init__(self):
+        self.indices = {}
+        self._lock = threading.Lock()
+
+    def load_index(self, name, path):
+        """Replace an index with one loaded from a snapshot file."""
+        index = MemoryIndex.load(path)
+        with self._lock:
+            self.indices[name] = index
+
+    def get_index(self, name):
+        with self._lock:
+            try:
+                return self.indices[name]
+            except KeyError:
+                self.indices[name] = MemoryIndex()
+                return self.indices[name]
+
+
+def index_documents(client, index_name, documents, **kwargs):
+    """Index a series of documents into an in-memory index.
+
+    This takes the same arguments as ``taggle.elastic.index_documents``;
+    the ones that only make sense for Elasticsearch are ignored.
+
+    """
+    client.get_index(index_name).index_documents(documents)
+
+
+def search_documents(client,
+                     index_name,
+                     query_string,
+                     query_params=None,
+                     page=1,
+                     page_size=96,
+                     **kwargs):
+    """Search an in-memory index, and return a ``ResultList``.
+
+    This takes the same arguments as ``taggle.elastic.search_documents``.
+    ``query_params`` is Elasticsearch query DSL, so it's ignored, as are
+    cursors -- paging by offset is already cheap in memory.
+
+    """
+    return client.get_index(index_name).search(
+        query_string=query_string,
+        page=page,
+        page_size=page_size
+    )
@@ -1,11 +1,51 @@
 # -*- encoding: utf-8
 
+from collections.abc import Mapping, Sequence
 import datetime as dt
+import math
+import sys
+import threading
 
 import attr
 
+from taggle import serializer
 
-@attr.s(init=False)
+
+class LazyMetadata(Mapping):
+    """A read-only mapping that decodes a JSON payload the first time it's
+    accessed.
+
+    Templates rarely read every field of every document, so this lets us
+    skip decoding the ones we never look at.
+
+    """
+
+    __slots__ = ('_payload', '_data')
+
+    def __init__(self, payload):
+        self._payload = payload
+        self._data = None
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self._decoded())
+
+    def _decoded(self):
+        if self._data is None:
+            self._data = serializer.loads(self._payload)
+            self._payload = None
+        return self._data
+
+    def __getitem__(self, key):
+        return self._decoded()[key]
+
+    def __iter__(self):
+        return iter(self._decoded())
+
+    def __len__(self):
+        return len(self._decoded())
+
+
+@attr.s(init=False, slots=True)
 class TaggedDocument:
     id = attr.ib()
     tags = attr.ib()
@@ -14,13 +54,114 @@ class TaggedDocument:
 
     def __init__(self, id, tags, date_added=None, **metadata):
         self.id = id
-        self.tags = tags
+
+        # The same few hundred tags appear on thousands of documents, so
+        # we intern them to share one copy of each string.
+        self.tags = [sys.intern(t) for t in tags]
         self.date_added = date_added or dt.datetime.now()
-        self.metadata = metadata.get('metadata') or metadata
-        super().__init__()
+
+        # Check for the key rather than the truthiness of its value, which
+        # would decode a ``LazyMetadata`` straight away.
+        if metadata.get('metadata') is not None:
+            self.metadata = metadata['metadata']
+        else:
+            self.metadata = metadata
 
     def __getattr__(self, name):
+        # Only called for attributes that aren't set; don't look for the
+        # metadata in itself if it hasn't been set yet.
+        if name == 'metadata':
+            raise AttributeError(name)
+
         try:
             return self.metadata[name]
         except KeyError:
             raise AttributeError(name)
+
+    @classmethod
+    def from_hit(cls, hit):
+        """Build a document from an Elasticsearch hit.
+
+        The ``_source`` of the hit is reused as the document's metadata,
+        rather than copied, so the hit shouldn't be used afterwards.
+
+        """
+        source = hit['_source']
+
+        doc = cls.__new__(cls)
+        doc.id = hit['_id']
+        doc.tags = [sys.intern(t) for t in source.pop('tags', ())]
+        doc.date_added = source.pop('date_added', None) or dt.datetime.now()
+        source.pop('doc_id', None)
+        doc.metadata = source
+        return doc
+
+
+class LazyDocuments(Sequence):
+    """The documents for a list of Elasticsearch hits, built from each hit
+    the first time it's read.
+
+    Results are cached and shared between requests, so building a document
+    is done under a lock -- ``TaggedDocument.from_hit`` consumes the hit.
+
+    """
+
+    def __init__(self, hits):
+        self._hits = hits
+        self._documents = [None] * len(hits)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<%s documents=%d>' % (type(self).__name__, len(self))
+
+    def __len__(self):
+        return len(self._hits)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+
+        doc = self._documents[idx]
+        if doc is None:
+            with self._lock:
+                doc = self._documents[idx]
+                if doc is None:
+                    doc = TaggedDocument.from_hit(self._hits[idx])
+                    self._documents[idx] = doc
+        return doc
+
+
+@attr.s
+class ResultList:
+    """Represents a set of results from a search.
+
+    This stores some information about the results from the query, and
+    some convenience methods about records on the query.
+
+    ``documents`` can be any sequence of ``TaggedDocument`` instances,
+    e.g. a ``LazyDocuments``.
+
+    If the results came from a sorted query, ``next_cursor`` and
+    ``prev_cursor`` can be passed back to ``search_documents`` to fetch
+    the adjacent pages with ``search_after``.
+
+    """
+    total_size = attr.ib()
+    page = attr.ib()
+    page_size = attr.ib()
+    documents = attr.ib()
+    tags = attr.ib()
+    next_cursor = attr.ib(default=None)
+    prev_cursor = attr.ib(default=None)
+
+    @property
+    def start_idx(self):
+        return 1 + self.page_size * (self.page - 1)
+
+    @property
+    def end_idx(self):
+        return min(self.total_size, self.page_size * self.page)
+
+    @property
+    def total_pages(self):
+        return math.ceil(self.total_size / self.page_size)
@@ -0,0 +1,53 @@
+# -*- encoding: utf-8
+"""Parse query strings into a form that's cheap to turn into a search.
+
+A query string is a mix of tag filters (``tags:python``) and free text.
+Parsing one means tokenising it with ``shlex``, so we do it once per
+distinct query string and keep the result.
+
+"""
+
+import functools
+import shlex
+
+import attr
+
+
+@attr.s(frozen=True)
+class QueryPlan:
+    """The parsed form of a query string.
+
+    The tags are sorted, because their order doesn't affect the results --
+    two query strings that compile to equal plans always return the same
+    documents, so a plan can be used as a cache key.
+
+    """
+    free_text = attr.ib()
+    tags = attr.ib()
+
+    @property
+    def is_filter_only(self):
+        return not self.free_text
+
+
+def _is_tag(token):
+    return token.startswith('tags:')
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_query(query_string):
+    """Parse a query string into a ``QueryPlan``."""
+    query_string = query_string.strip()
+
+    # Attempt to split the query string into tokens, but don't try too hard.
+    # If it fails, we shouldn't error here --- better for it to error when it
+    # hits Elasticsearch, if at all.
+    try:
+        tokens = shlex.split(query_string)
+    except ValueError:
+        tokens = [query_string]
+
+    return QueryPlan(
+        free_text=' '.join(t for t in tokens if not _is_tag(t)),
+        tags=tuple(sorted(t.split(':', 1)[-1] for t in tokens if _is_tag(t)))
+    )
@@ -0,0 +1,64 @@
+# -*- encoding: utf-8
+"""Read and write JSON, as fast as the installed libraries allow.
+
+If orjson is installed, we use it -- it's several times faster than the
+``json`` module, at both ends, which matters for the Elasticsearch
+responses we decode on every search and the metadata caches we read on
+every index update.  Otherwise we fall back to ``json``.
+
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def _default(obj):
+    # Anything that isn't JSON already, e.g. a datetime, is stored as its
+    # string -- which is what ``json.dumps(default=str)`` does.
+    return str(obj)
+
+
+def loads(data):
+    """Decode a JSON document, given as a ``str`` or ``bytes``."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj, default=_default):
+    """Encode ``obj`` as a compact JSON ``str``.
+
+    ``default`` is called for any object that can't be serialised, and
+    should return something that can.
+
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                obj, default=default, option=orjson.OPT_NON_STR_KEYS
+            ).decode('utf8')
+
+        # orjson is stricter than the json module -- e.g. it won't encode
+        # integers bigger than 64 bits -- so let that have a go instead.
+        except orjson.JSONEncodeError:
+            pass
+
+    return json.dumps(
+        obj, default=default, ensure_ascii=False, separators=(',', ':')
+    )
+
+
+def load(path):
+    """Read a JSON file."""
+    with open(path, 'rb') as infile:
+        return loads(infile.read())
+
+
+def dump(obj, path):
+    """Write ``obj`` to a JSON file."""
+    with open(path, 'w', encoding='utf8') as outfile:
+        outfile.write(dumps(obj))
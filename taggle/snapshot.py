@@ -0,0 +1,220 @@
+# -*- encoding: utf-8
+"""Save a ``MemoryIndex`` to disk in a form that can be mmap'd back in.
+
+If several worker processes serve the same index, loading a snapshot
+means they don't each rebuild it from scratch, and the bulk of it -- the
+postings and the document records -- lives in the OS page cache, shared
+between them, rather than in each process.
+
+The layout of a snapshot file is:
+
+*   an 8-byte magic string and the length of the header (uint64)
+*   the header, as JSON: the document IDs and dates, and the offset and
+    length of each tag's and each word's postings
+*   the byte offset of each document record (uint64, one per document plus
+    an end marker)
+*   the postings, as sorted arrays of document ordinals (uint32)
+*   the document records: the ID, tags and date as a line of JSON, then the
+    rest of the metadata as JSON, which isn't decoded until it's used
+
+All the numbers are little-endian, and the binary sections start on an
+8-byte boundary.
+
+"""
+
+import array
+import json
+import mmap
+import os
+import struct
+import sys
+
+import attr
+
+from taggle.models import LazyMetadata, TaggedDocument
+
+
+MAGIC = b'TAGGLE02'
+
+_HEADER_LENGTH = struct.Struct('<Q')
+
+
+def _pad(length):
+    return -length % 8
+
+
+def _little_endian(arr):
+    if sys.byteorder != 'little':
+        arr = array.array(arr.typecode, arr)
+        arr.byteswap()
+    return arr
+
+
+def _view(buf, start, length, typecode):
+    """Returns ``length`` items of ``buf`` starting at byte ``start``, as
+    numbers -- without copying them, if we can.
+    """
+    itemsize = array.array(typecode).itemsize
+    view = memoryview(buf)[start:start + length * itemsize]
+    if sys.byteorder == 'little':
+        return view.cast(typecode)
+    return _little_endian(array.array(typecode, view.tobytes()))
+
+
+def _encode_document(doc):
+    record = json.dumps([doc.id, doc.tags, doc.date_added], default=str)
+    metadata = json.dumps(dict(doc.metadata), default=str)
+    return f'{record}\n{metadata}'.encode('utf8')
+
+
+def write_snapshot(path, documents, tags, words):
+    """Write a snapshot to ``path``.
+
+    :param documents: A list of ``TaggedDocument`` instances.  The position
+        of each document in the list is its ordinal.
+    :param tags: A dict from tag to a sorted list of ordinals.
+    :param words: A dict from word to a sorted list of ordinals.
+
+    The file is written alongside ``path`` and then moved into place, so a
+    process that loads it never sees half a snapshot.
+
+    """
+    postings = array.array('I')
+    postings_index = {}
+    for name, terms in (('tags', tags), ('words', words)):
+        postings_index[name] = {}
+        for term, ordinals in terms.items():
+            postings_index[name][term] = [len(postings), len(ordinals)]
+            postings.extend(ordinals)
+
+    records = [_encode_document(doc) for doc in documents]
+    record_offsets = array.array('Q', [0])
+    for record in records:
+        record_offsets.append(record_offsets[-1] + len(record))
+
+    header = json.dumps({
+        'ids': [doc.id for doc in documents],
+        'dates': [str(doc.date_added) for doc in documents],
+        'tags': postings_index['tags'],
+        'words': postings_index['words'],
+    }).encode('utf8')
+    header += b' ' * _pad(len(MAGIC) + _HEADER_LENGTH.size + len(header))
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as outfile:
+        outfile.write(MAGIC)
+        outfile.write(_HEADER_LENGTH.pack(len(header)))
+        outfile.write(header)
+        outfile.write(_little_endian(record_offsets).tobytes())
+        outfile.write(_little_endian(postings).tobytes())
+        outfile.write(b'\0' * _pad(len(postings) * postings.itemsize))
+        for record in records:
+            outfile.write(record)
+
+    os.replace(tmp_path, path)
+
+
+class SnapshotDocuments:
+    """The documents in a snapshot, decoded from the file as they're read.
+
+    Documents can be replaced or added; those are kept in memory, and the
+    file is never modified.
+
+    """
+
+    def __init__(self, buf, offsets, start):
+        self._buf = buf
+        self._offsets = offsets
+        self._start = start
+        self._length = len(offsets) - 1
+        self._overrides = {}
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for ordinal in range(len(self)):
+            yield self[ordinal]
+
+    def __getitem__(self, ordinal):
+        if ordinal in self._overrides:
+            return self._overrides[ordinal]
+        if not 0 <= ordinal < self._length:
+            raise IndexError(ordinal)
+
+        start = self._start + self._offsets[ordinal]
+        end = self._start + self._offsets[ordinal + 1]
+        record, metadata = self._buf[start:end].split(b'\n', 1)
+        doc_id, tags, date_added = json.loads(record)
+        return TaggedDocument(
+            id=doc_id,
+            tags=tags,
+            date_added=date_added,
+            metadata=LazyMetadata(metadata)
+        )
+
+    def __setitem__(self, ordinal, doc):
+        if not 0 <= ordinal < self._length:
+            raise IndexError(ordinal)
+        self._overrides[ordinal] = doc
+
+    def append(self, doc):
+        self._overrides[self._length] = doc
+        self._length += 1
+
+
+@attr.s
+class Snapshot:
+    ids = attr.ib()
+    dates = attr.ib()
+    documents = attr.ib()
+    tags = attr.ib()
+    words = attr.ib()
+
+
+def read_snapshot(path):
+    """mmap a snapshot written by ``write_snapshot``.
+
+    The postings are returned as views of the file, so they aren't read
+    until they're used, and are shared with any other process that has
+    the same file open.
+
+    """
+    with open(path, 'rb') as infile:
+        buf = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if buf[:len(MAGIC)] != MAGIC:
+        raise ValueError(f'{path!r} is not a taggle snapshot')
+
+    offset = len(MAGIC)
+    header_length, = _HEADER_LENGTH.unpack_from(buf, offset)
+    offset += _HEADER_LENGTH.size
+    header = json.loads(buf[offset:offset + header_length].decode('utf8'))
+    offset += header_length
+
+    count = len(header['ids'])
+    record_offsets = _view(buf, offset, count + 1, 'Q')
+    offset += (count + 1) * 8
+
+    postings_start = offset
+    postings_length = sum(
+        length
+        for terms in (header['tags'], header['words'])
+        for _, length in terms.values()
+    )
+    offset += postings_length * 4
+    offset += _pad(postings_length * 4)
+
+    def _postings(terms):
+        return {
+            term: _view(buf, postings_start + start * 4, length, 'I')
+            for term, (start, length) in terms.items()
+        }
+
+    return Snapshot(
+        ids=header['ids'],
+        dates=header['dates'],
+        documents=SnapshotDocuments(buf, record_offsets, start=offset),
+        tags=_postings(header['tags']),
+        words=_postings(header['words'])
+    )
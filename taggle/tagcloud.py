@@ -5,8 +5,18 @@ Based on https://github.com/addywaddy/jquery.tagcloud.js, ported to Python.
 
 """
 
+import bisect
+import math
+
 import attr
 
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+from taggle.cache import LRUCache
+
 
 @attr.s
 class _HexColour:
@@ -14,27 +24,6 @@ class _HexColour:
     green = attr.ib()
     blue = attr.ib()
 
-    @property
-    def ashex(self):
-        return '#%02x%02x%02x' % (
-            int(self.red), int(self.green), int(self.blue))
-
-    def __add__(self, other):
-        assert isinstance(other, _HexColour)
-        return _HexColour(
-            red=(self.red + other.red),
-            green=(self.green + other.green),
-            blue=(self.blue + other.blue)
-        )
-
-    def __mul__(self, other):
-        assert isinstance(other, int)
-        return _HexColour(
-            red=(self.red * other),
-            green=(self.green * other),
-            blue=(self.blue * other)
-        )
-
 
 def _hex_colour(c):
     c = c.lstrip('#')
@@ -45,29 +34,130 @@ def _hex_colour(c):
     return _HexColour(red=red, green=green, blue=blue)
 
 
-def _colour_increment(colr_start, colr_end, weight_range):
-    return _HexColour(
-        red=(colr_start.red - colr_end.red) / weight_range,
-        green=(colr_start.green - colr_end.green) / weight_range,
-        blue=(colr_start.blue - colr_end.blue) / weight_range,
-    )
-
-
 @attr.s
 class TagcloudOptions:
+    """How to draw a tag cloud.
+
+    Tags are sized and coloured between the start and end values, by their
+    ``weighting``:
+
+    *   ``linear``: in proportion to their count
+    *   ``log`` or ``sqrt``: in proportion to the log or square root of
+        their count, so one very common tag doesn't squash the rest into
+        the smallest sizes
+    *   ``quantile``: by which of ``buckets`` equal-sized groups of tags
+        their count falls into, so every size is used
+
+    """
     size_start = attr.ib()
     size_end = attr.ib()
 
     colr_start = attr.ib(convert=_hex_colour)
     colr_end = attr.ib(convert=_hex_colour)
 
+    weighting = attr.ib(
+        default='linear',
+        validator=attr.validators.in_(['linear', 'log', 'sqrt', 'quantile'])
+    )
+    buckets = attr.ib(default=10)
+
 
-@attr.s
+@attr.s(frozen=True)
 class TagcloudEntry:
     size = attr.ib()
     colr = attr.ib()
 
 
+# If there are fewer distinct weights than this, it's quicker to work out
+# their entries in Python than to set up the arrays for NumPy.
+NUMPY_MIN_WEIGHTS = 512
+
+
+def _entries(weightings, options, weight_range):
+    """Returns the ``TagcloudEntry`` for each of ``weightings``, which run
+    from 0 for the smallest tags to ``weight_range`` for the biggest.
+
+    The arithmetic is done in the same order whether or not we use NumPy,
+    so the results are the same to the last bit.
+
+    """
+    font_incr = (options.size_end - options.size_start) / weight_range
+
+    start = options.colr_start
+    end = options.colr_end
+    channels = [
+        (start.red, (end.red - start.red) / weight_range),
+        (start.green, (end.green - start.green) / weight_range),
+        (start.blue, (end.blue - start.blue) / weight_range),
+    ]
+
+    # Each colour is packed into a single int, 0xRRGGBB, so it can be
+    # formatted in one go.
+    if numpy is not None and len(weightings) >= NUMPY_MIN_WEIGHTS:
+        w = numpy.array(weightings, dtype=numpy.float64)
+        sizes = (options.size_start + font_incr * w).tolist()
+        colours = numpy.zeros(len(weightings), dtype=numpy.int64)
+        for channel_start, channel_incr in channels:
+            colours <<= 8
+            colours |= (channel_start + channel_incr * w).astype(numpy.int64)
+        colours = colours.tolist()
+    else:
+        sizes = [options.size_start + font_incr * w for w in weightings]
+        colours = [0] * len(weightings)
+        for channel_start, channel_incr in channels:
+            colours = [
+                colour << 8 | int(channel_start + channel_incr * w)
+                for colour, w in zip(colours, weightings)
+            ]
+
+    return [
+        TagcloudEntry(size=size, colr='#%06x' % colour)
+        for size, colour in zip(sizes, colours)
+    ]
+
+
+def _linear_weightings(distinct):
+    weight_min = min(distinct)
+    return [w - weight_min for w in distinct], max(distinct) - weight_min
+
+
+def _log_weightings(distinct):
+    weight_min = min(distinct)
+    return (
+        [math.log1p(w - weight_min) for w in distinct],
+        math.log1p(max(distinct) - weight_min)
+    )
+
+
+def _sqrt_weightings(distinct):
+    weight_min = min(distinct)
+    return (
+        [math.sqrt(w - weight_min) for w in distinct],
+        math.sqrt(max(distinct) - weight_min)
+    )
+
+
+def _quantile_weightings(weights, distinct, buckets):
+    # The boundaries between buckets are the weights at evenly spaced
+    # ranks.  A weight goes in the bucket after the last boundary below it,
+    # so tags with the same weight always share a bucket.  NumPy can find
+    # the boundaries with a partial sort; in Python, sorting is quickest.
+    ranks = [len(weights) * i // buckets for i in range(1, buckets)]
+    if not ranks:
+        weightings = [0] * len(distinct)
+    elif numpy is not None and len(weights) >= NUMPY_MIN_WEIGHTS:
+        partitioned = numpy.partition(numpy.array(list(weights)), ranks)
+        weightings = numpy.searchsorted(
+            partitioned[ranks], distinct, side='left'
+        ).tolist()
+    else:
+        sorted_weights = sorted(weights)
+        boundaries = [sorted_weights[r] for r in ranks]
+        weightings = [bisect.bisect_left(boundaries, w) for w in distinct]
+
+    return weightings, max(weightings)
+
+
 def build_tag_cloud(counter, options):
     """Get the font/size for every element in ``counter`` for rendering
     a tag cloud.
@@ -75,24 +165,65 @@ def build_tag_cloud(counter, options):
     if not counter:
         return {}
 
+    # Most tags share their count with lots of others, so we only work out
+    # the entry for each distinct count, and look the tags up in that.
     weights = counter.values()
-    weight_min = min(weights)
-    weight_max = max(weights)
+    distinct = list(set(weights))
+
+    if options.weighting == 'quantile':
+        weightings, weight_range = _quantile_weightings(
+            weights, distinct, buckets=options.buckets
+        )
+    else:
+        weightings, weight_range = {
+            'linear': _linear_weightings,
+            'log': _log_weightings,
+            'sqrt': _sqrt_weightings,
+        }[options.weighting](distinct)
 
-    weight_range = weight_max - weight_min
     if weight_range == 0:
         weight_range = 1
 
-    font_incr = (options.size_end - options.size_start) / weight_range
-    colr_incr = _colour_increment(
-        options.colr_end, options.colr_start, weight_range=weight_range
-    )
+    lookup = dict(zip(distinct, _entries(weightings, options, weight_range)))
+
+    return {label: lookup[weight] for label, weight in counter.items()}
+
+
+# Most page views are for a handful of popular queries, so we keep the tag
+# clouds for those, and the HTML rendered from them.
+_cloud_cache = LRUCache(max_entries=256)
+_fragment_cache = LRUCache(max_entries=256, max_bytes=16 * 1024 * 1024)
+
+
+def _cache_key(counter, options):
+    return (frozenset(counter.items()), attr.astuple(options))
 
-    result = {}
-    for label, weight in counter.items():
-        weighting = weight - weight_min
-        font_size = options.size_start + font_incr * weighting
-        font_colr = options.colr_start + colr_incr * weighting
-        result[label] = TagcloudEntry(size=font_size, colr=font_colr.ashex)
 
-    return result
+def cached_tag_cloud(counter, options):
+    """Like ``build_tag_cloud``, but remembers the results for recently
+    seen tag counts.  The dict that's returned is shared, so don't modify
+    it.
+    """
+    key = _cache_key(counter, options)
+    tag_cloud = _cloud_cache.get(key)
+    if tag_cloud is None:
+        tag_cloud = build_tag_cloud(counter, options)
+        _cloud_cache.set(key, tag_cloud)
+    return tag_cloud
+
+
+def render_tag_cloud(counter, options, query_string, render, template=None):
+    """Returns the HTML for a tag cloud, from ``render(tag_cloud)``.
+
+    The HTML is cached, keyed on the tag counts, the options and the query
+    string (which the links in the cloud depend on), so ``render`` should
+    depend on nothing else.  If there's more than one way to render a tag
+    cloud, give each one a different ``template`` name.
+
+    """
+    key = (template, query_string) + _cache_key(counter, options)
+    fragment = _fragment_cache.get(key)
+    if fragment is None:
+        fragment = render(cached_tag_cloud(counter, options))
+        _fragment_cache.set(key, fragment, size=len(fragment))
+    return fragment